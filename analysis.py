@@ -8,13 +8,12 @@
 
 import os, re, time, string, random
 
-from numpy import median, nan, arange
-import matplotlib.pyplot as plt
-
 from datetime import datetime
 
-from database import dbQuery, createDirectory
+from database import cachedQuery, createDirectory, getPlayerDB, ballsToOvers
 from fetch import getClubList
+from profiler import profiled, timed
+from snapshot import loadPlayerSnapshot, selectRows, distinctValues, battingTotals, bowlingTotals, isIn, countTrue
 
 ###############################################################################
 # User Input / Config
@@ -29,14 +28,22 @@ showAll = True
 ###############################################################################
 # Functions
 
+# matplotlib (and the numpy it brings with it) is slow to import, so it's only imported once a graph is actually drawn.
+# Agg, since graphs are only ever saved to file. Also saves it looking for a GUI backend
+def getPyplot():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
 def setGlobals(playerStatsFromMain):
     global playerStats
     playerStats = playerStatsFromMain
 
 def stats_PlayerInfo(playerID):
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
-    games = dbQuery(playerDB, "SELECT NumMatches FROM PlayerInfo")
+    playerDB = getPlayerDB(playerID)
+    games = cachedQuery(playerDB, "SELECT NumMatches FROM PlayerInfo")
     if games:
         return games[0][0]
     else:
@@ -151,34 +158,40 @@ def getBattingStats(inningsList):
     #headers = ("Innings", "High Score", "Not Outs", "Ducks", "25s", "50s", "100s", "Aggregate", "Average")
     headers = ("Innings", "High Score", "Not Outs", "Ducks", "25s", "50s", "100s", "Aggregate", "Average", "25+ Scores", "25+ %", "Duck %")
 
-    # Initialise and zero all variables
-    numInnings = highScore = notOuts = ducks = twentyFives = fifties = hundreds = aggregate = 0
-    average = 0.0
+    # Innings from a player snapshot - Let numpy do the counting
+    if isinstance(inningsList, dict):
+        numInnings, highScore, notOuts, ducks, twentyFives, fifties, hundreds, aggregate = battingTotals(inningsList)
 
-    # Iterate over innings list
-    for innings in inningsList:
-        
-        numInnings += 1
+    else:
+        # Initialise and zero all variables
+        numInnings = highScore = notOuts = ducks = twentyFives = fifties = hundreds = aggregate = 0
 
-        if innings[3] > highScore:
-            highScore = innings[3]
+        # Iterate over innings list
+        for innings in inningsList:
+            
+            numInnings += 1
 
-        if (innings[5] == 'no') or (innings[5] == 'rtno'):
-            notOuts += 1
+            if innings[3] > highScore:
+                highScore = innings[3]
 
-        if (innings[3] == 0) and (innings[5] != 'no'):
-            ducks += 1
+            if (innings[5] == 'no') or (innings[5] == 'rtno'):
+                notOuts += 1
+
+            if (innings[3] == 0) and (innings[5] != 'no'):
+                ducks += 1
 
-        if (innings[3] >= 25) and (innings[3] < 50):
-            twentyFives += 1
+            if (innings[3] >= 25) and (innings[3] < 50):
+                twentyFives += 1
 
-        if (innings[3] >= 50) and (innings[3] < 100):
-            fifties += 1
+            if (innings[3] >= 50) and (innings[3] < 100):
+                fifties += 1
 
-        if innings[3] >= 100:
-            hundreds += 1
+            if innings[3] >= 100:
+                hundreds += 1
 
-        aggregate += innings[3]
+            aggregate += innings[3]
+
+    average = 0.0
 
     # Calculate Batting Average (rounded to 2 decimal places)
     try:
@@ -204,21 +217,29 @@ def getBowlingStats(inningsList):
     # New - Updated to match order. + 5WI
     headers = ("Innings", "Overs", "Maidens", "Wickets", "Runs", "5WI", "Average", "Strike Rate", "Economy")
 
-    # Initialise and zero all variables
-    numInnings = runs = maidens = wickets = fivefa = 0
-    overs = average = strikeRate = economy = 0.0
+    # Innings from a player snapshot - Let numpy do the counting
+    if isinstance(inningsList, dict):
+        numInnings, balls, maidens, wickets, runs, fivefa = bowlingTotals(inningsList)
 
-    # Iterate over innings list
-    for innings in inningsList:
-        
-        numInnings += 1
+    else:
+        # Initialise and zero all variables
+        numInnings = runs = maidens = wickets = fivefa = balls = 0
+
+        # Iterate over innings list
+        for innings in inningsList:
+            
+            numInnings += 1
+
+            balls += innings[7]
+            wickets += innings[4]
+            maidens += innings[6]
+            runs += innings[5]
+            if innings[4] >= 5:
+                fivefa += 1
+
+    average = strikeRate = economy = 0.0
 
-        overs += int( float( innings[3] ) ) # Fix this
-        wickets += innings[4]
-        maidens += innings[6]
-        runs += innings[5]
-        if innings[4] >= 5:
-            fivefa += 1
+    overs = ballsToOvers(balls)
 
     # Calculate Bowling Average (rounded to 2 decimal places)
     try:
@@ -229,7 +250,6 @@ def getBowlingStats(inningsList):
 
     # Calculate Bowling Strike Rate (rounded to 2 decimal places)
     try:
-        balls = (overs * 6) # fix this
         rawStrikeRate = balls / wickets 
         strikeRate = round(rawStrikeRate, 2)
     except ZeroDivisionError:
@@ -237,7 +257,7 @@ def getBowlingStats(inningsList):
 
     # Calculate Bowling Economy (rounded to 2 decimal places)
     try:
-        rawEconomy = runs / overs # fix this
+        rawEconomy = runs / (balls / 6)
         economy = round(rawEconomy, 2)
     except ZeroDivisionError:
         economy = "N/A"
@@ -248,36 +268,32 @@ def getBowlingStats(inningsList):
     return headers, stats
 
 # Analyse all innings for player, for a given discipline
+@profiled()
 def stats_Overall(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
 
     caption = discipline + " - Overall Summary"
 
-    inningsList = dbQuery(playerDB,"SELECT * FROM "+ discipline)# Batting")
+    inningsList = loadPlayerSnapshot(playerID)[discipline]
 
     disciplineHelper(discipline, inningsList, caption)
 
-# Stats by Season
-def stats_Season(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
-
-    caption = discipline + " - Stats by Season"
+# Shared by the "Stats by X" functions. One table row for each value, of the innings where column == value
+def statsByColumnHelper(playerID, discipline, column, values, indexHeader, caption, extraDivClass, labels=None):
 
-    seasonList = dbQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
+    innings = loadPlayerSnapshot(playerID)[discipline]
 
     indexCount = 0
 
-    for season in sorted(seasonList):
-
-        seasonString = str( season[0] )
-
-        matchList = dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
+    for i, value in enumerate(values):
 
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
+        if labels:
+            label = labels[i]
+        else:
+            label = str(value)
 
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
+        inningsList = selectRows(innings, innings[column] == value)
 
-        multiLineDisciplineHelper(discipline, inningsList, "Season", seasonString, indexCount, caption, "season")
+        multiLineDisciplineHelper(discipline, inningsList, indexHeader, label, indexCount, caption, extraDivClass)
 
         indexCount += 1
 
@@ -286,81 +302,53 @@ def stats_Season(playerID, discipline):
 
     accordionHelperEnd()
 
+# Stats by Season
+@profiled()
+def stats_Season(playerID, discipline):
 
-# Stats by Opponent
-def stats_Opponent(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
-
-    caption = discipline + " - Stats by Opponent"
-
-    opponentList = dbQuery(playerDB, "SELECT DISTINCT Opponent FROM Matches ORDER BY Opponent ASC")
-
-    indexCount = 0
+    caption = discipline + " - Stats by Season"
 
-    for opponent in opponentList:
+    seasonList = distinctValues( loadPlayerSnapshot(playerID)["Matches"]["Season"] )
 
-        matchList = dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Opponent='" + opponent[0] + "'")
+    statsByColumnHelper(playerID, discipline, "Season", sorted(seasonList), "Season", caption, "season")
 
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
 
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
-        
-        multiLineDisciplineHelper(discipline, inningsList, "Opponent", opponent[0], indexCount, caption, "opponent")
+# Stats by Opponent
+@profiled()
+def stats_Opponent(playerID, discipline):
 
-        indexCount += 1
+    caption = discipline + " - Stats by Opponent"
 
-    playerStats.write("</tbody></table>")
-    playerStats.write("</div>")
+    opponentList = distinctValues( loadPlayerSnapshot(playerID)["Matches"]["Opponent"] )
 
-    accordionHelperEnd()
+    statsByColumnHelper(playerID, discipline, "Opponent", sorted(opponentList), "Opponent", caption, "opponent")
 
 # Stats by Grade
+@profiled()
 def stats_Grade(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
 
     caption = discipline + " - Stats by Grade"
 
-    gradeList = dbQuery(playerDB, "SELECT DISTINCT Grade FROM Matches ORDER BY Grade ASC")
-
-    indexCount = 0
-
-    for grade in sorted(gradeList):
-
-        gradeString = str( grade[0] )
-
-        matchList = dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Grade='" + grade[0] + "'")
-
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
+    gradeList = distinctValues( loadPlayerSnapshot(playerID)["Matches"]["Grade"] )
 
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
-        
-        multiLineDisciplineHelper(discipline, inningsList, "Grade", gradeString, indexCount, caption, "grade")
-
-        indexCount += 1
-    
-    playerStats.write("</tbody></table>")
-    playerStats.write("</div>")
-
-    accordionHelperEnd()
+    statsByColumnHelper(playerID, discipline, "Grade", sorted(gradeList), "Grade", caption, "grade")
 
 # Stats by HomeOrAway - FIX THIS FOR HTML OUTPUT
+@profiled()
 def stats_HomeOrAway(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+
+    innings = loadPlayerSnapshot(playerID)[discipline]
 
     playerStats.write( discipline + " - Stats by Home/Away"+"\n" )
 
     playerStats.write( "Home"+"\n" )
-    matchList = dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE HomeOrAway='Home'")
-    formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
-    inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
+    inningsList = selectRows(innings, innings["HomeOrAway"] == "Home")
     disciplineHelper(discipline, inningsList)
     #headers, stats = getBattingStats(inningsList)
     #printStats(headers, stats)
 
     playerStats.write( "Away"+"\n" )
-    matchList = dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE HomeOrAway='Away'")
-    formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
-    inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
+    inningsList = selectRows(innings, innings["HomeOrAway"] == "Away")
     disciplineHelper(discipline, inningsList)
     #headers, stats = getBattingStats(inningsList)
     #printStats(headers, stats)
@@ -368,75 +356,62 @@ def stats_HomeOrAway(playerID, discipline):
     playerStats.write("\n")
 
 # Stats by Club
+@profiled()
 def stats_Club(playerID, discipline):
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
-
     caption = discipline + " - Stats by Club"
 
     clubList = getClubList(playerID)
 
-    indexCount = 0
-    for clubID, clubName in clubList:
+    clubIDs = [ clubID for clubID, clubName in clubList ]
+    clubNames = [ clubName for clubID, clubName in clubList ]
 
-        matchList = dbQuery(playerDB, "SELECT * FROM Matches where ClubID =" + str(clubID) )
+    statsByColumnHelper(playerID, discipline, "ClubID", clubIDs, "Club", caption, "club", clubNames)
 
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
+def recentHelper(playerID, discipline, numSeasons, seasonList, caption="Default Caption"):
 
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline+ " WHERE MatchID IN " + formattedMatchList) 
-        
-        multiLineDisciplineHelper(discipline, inningsList, "Club", clubName, indexCount, caption, "club")
+    innings = loadPlayerSnapshot(playerID)[discipline]
 
-        indexCount += 1
-        
-    playerStats.write("</tbody></table>")
-    playerStats.write("</div>")
-
-    accordionHelperEnd()
-
-def recentHelper(playerDB, discipline, numSeasons, seasonList, caption="Default Caption"):
-    matchList = []
+    recentSeasons = sorted(seasonList)[-numSeasons:]
 
-    for season in sorted(seasonList)[-numSeasons:]:
-
-        matchList += dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
-
-    formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
-
-    inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
+    inningsList = selectRows(innings, isIn(innings["Season"], recentSeasons))
 
     disciplineHelper(discipline, inningsList, caption, True)
     
     playerStats.write("\n")
 
 # Stats for past X seasons
+@profiled()
 def stats_Recent(playerID, discipline, numSeasons):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
 
     #playerStats.write( discipline + " - Recent Stats"+"\n" )
 
-    seasonList = dbQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
+    seasonList = distinctValues( loadPlayerSnapshot(playerID)["Matches"]["Season"] )
 
     # Call Overall Stats
     #stats_Batting_Overall(playerID)
 
     # Stats for Last Season
     caption = discipline + " - Last/Current Season"
-    recentHelper(playerDB, discipline, 1, seasonList, caption)
+    recentHelper(playerID, discipline, 1, seasonList, caption)
 
     # Stats for Last X Seasons
     caption =  discipline + " - Last " + str(numSeasons) + " Seasons"
-    recentHelper(playerDB, discipline, numSeasons+1, seasonList, caption)
+    recentHelper(playerID, discipline, numSeasons+1, seasonList, caption)
     
     playerStats.write("\n")
 
 # Stats for past juniors/seniors
+@profiled()
 def stats_JuniorSenior(playerID, discipline):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+
+    snapshot = loadPlayerSnapshot(playerID)
+    matches = snapshot["Matches"]
+    innings = snapshot[discipline]
 
     #playerStats.write( discipline + " - Junior/Senior Stats"+"\n" )
 
-    gradeList = dbQuery(playerDB, "SELECT DISTINCT Grade FROM Matches")
+    gradeList = sorted(distinctValues(matches["Grade"]))
 
     # Strings to look for in grade name
     juniorStrings = ["under", "11","12","13","14","15","16","17","18","19","21"]#"20" - T20 gets flagged if we leave that in.
@@ -447,102 +422,53 @@ def stats_JuniorSenior(playerID, discipline):
     for grade in gradeList:
         
         for string in juniorStrings:
-            if string in grade[0].lower():
+            if string in grade.lower():
                 
-                if grade[0] not in juniorList:
-                    juniorList += [grade[0]]
-
-        if grade[0] not in juniorList:
-            seniorList += [grade[0]]
-        
-    juniorMatchList = []
-    seniorMatchList = []
+                if grade not in juniorList:
+                    juniorList += [grade]
 
-    for grade in juniorList:
+        if grade not in juniorList:
+            seniorList += [grade]
 
-        juniorMatchList += dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Grade='" + grade + "'")
+    numJuniorMatches = countTrue(isIn(matches["Grade"], juniorList))
+    numSeniorMatches = countTrue(isIn(matches["Grade"], seniorList))
 
-    for grade in seniorList:
-
-        seniorMatchList += dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Grade='" + grade + "'")
-
-    if juniorMatchList and seniorMatchList:
+    if numJuniorMatches and numSeniorMatches:
 
         #playerStats.write('<br><br>')
         #playerStats.write('<div class="card">')
 
-        # Juniors
-        matchList = juniorMatchList
-
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"   
-
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
-
-        caption = discipline + " Junior Stats"
-        #disciplineHelper(discipline, inningsList, caption)
-
-        headers = stats = ""
-
-        # Get stats for all innings
-        if discipline == "Batting":
-            headers, stats = getBattingStats(inningsList)
-        elif discipline == "Bowling":
-            headers, stats = getBowlingStats(inningsList)
+        for caption, gradeNames, numMatches, segment in [(discipline + " Junior Stats", juniorList, numJuniorMatches, "Junior"),
+                                                         (discipline + " Senior Stats", seniorList, numSeniorMatches, "Senior")]:
 
-        accordionHelperStart(caption, showAll)
-        if stats[0]:
-            #playerStats.write( "<caption>"+caption+"</caption>" )
-            playerStats.write('<div class="p-3 table-responsive">')
-            playerStats.write('<table class="table table-bordered table-sm" style="background-color:white">')
-            printStats(headers, stats)
-            playerStats.write("</tbody></table>")
-            playerStats.write("</div>")
-
-        else:
-            playerStats.write( '<p class="p-3">No stats available</p>' )
-
-
-        playerStats.write( '<p class="p-3">' )
-        playerStats.write( "Stats from " + str(len(matchList)) + " games in the following Junior Grades: " + str([i for i in juniorList]) )
-        playerStats.write( "</p>" )
-        
-        accordionHelperEnd()
+            inningsList = selectRows(innings, isIn(innings["Grade"], gradeNames))
 
-        # Seniors
+            headers = stats = ""
 
-        matchList = seniorMatchList
+            # Get stats for all innings
+            if discipline == "Batting":
+                headers, stats = getBattingStats(inningsList)
+            elif discipline == "Bowling":
+                headers, stats = getBowlingStats(inningsList)
 
-        formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"   
-
-        inningsList = dbQuery(playerDB, "SELECT * FROM " + discipline + " WHERE MatchID IN " + formattedMatchList) 
-
-        caption = discipline + " Senior Stats"
-        headers = stats = ""
-
-        # Get stats for all innings
-        if discipline == "Batting":
-            headers, stats = getBattingStats(inningsList)
-        elif discipline == "Bowling":
-            headers, stats = getBowlingStats(inningsList)
-
-        accordionHelperStart(caption, showAll)
-        if stats[0]:
-            #playerStats.write( "<caption>"+caption+"</caption>" )
-            playerStats.write('<div class="p-3 table-responsive">')
-            playerStats.write('<table class="table table-bordered table-sm" style="background-color:white">')
-            printStats(headers, stats)
-            playerStats.write("</tbody></table>")
-            playerStats.write("</div>")
-
-        else:
-            playerStats.write( '<p class="p-3">No stats available</p>' )
+            accordionHelperStart(caption, showAll)
+            if stats[0]:
+                #playerStats.write( "<caption>"+caption+"</caption>" )
+                playerStats.write('<div class="p-3 table-responsive">')
+                playerStats.write('<table class="table table-bordered table-sm" style="background-color:white">')
+                printStats(headers, stats)
+                playerStats.write("</tbody></table>")
+                playerStats.write("</div>")
 
+            else:
+                playerStats.write( '<p class="p-3">No stats available</p>' )
 
-        playerStats.write( '<p class="p-3">' )
-        playerStats.write( "Stats from " + str(len(matchList)) + " games in the following Senior Grades: " + str([i for i in seniorList]) )
-        playerStats.write( "</p>" )
 
-        accordionHelperEnd()
+            playerStats.write( '<p class="p-3">' )
+            playerStats.write( "Stats from " + str(numMatches) + " games in the following " + segment + " Grades: " + str([i for i in gradeNames]) )
+            playerStats.write( "</p>" )
+            
+            accordionHelperEnd()
         
         #playerStats.write('</div>')
     
@@ -552,7 +478,7 @@ def stats_JuniorSenior(playerID, discipline):
 ## Batting Only Stats
 
 def dismissalBreakdownHelper(playerID,numSeasons=False):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
 
     playerStats.write('<table class="table table-bordered table-sm caption-top">')
     #playerStats.write( "<caption>"+"Dismissal Breakdown"+"</caption>" )
@@ -561,17 +487,17 @@ def dismissalBreakdownHelper(playerID,numSeasons=False):
 
         matchList = []
 
-        seasonList = dbQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
+        seasonList = cachedQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
 
         for season in sorted(seasonList)[-numSeasons:]:
 
-            matchList += dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
+            matchList += cachedQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
             formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
         
-        dismissalStats = dbQuery(playerDB, "SELECT HowDismissed, COUNT(*) as Count from Batting WHERE MatchID IN " + formattedMatchList + "GROUP BY HowDismissed ORDER BY Count DESC")
+        dismissalStats = cachedQuery(playerDB, "SELECT HowDismissed, COUNT(*) as Count from Batting WHERE MatchID IN " + formattedMatchList + "GROUP BY HowDismissed ORDER BY Count DESC")
 
     else:
-        dismissalStats = dbQuery(playerDB, "SELECT HowDismissed, COUNT(*) as Count from Batting GROUP BY HowDismissed ORDER BY Count DESC")
+        dismissalStats = cachedQuery(playerDB, "SELECT HowDismissed, COUNT(*) as Count from Batting GROUP BY HowDismissed ORDER BY Count DESC")
 
 
     headers = [ str(i[0]) for i in dismissalStats ]
@@ -590,6 +516,7 @@ def dismissalBreakdownHelper(playerID,numSeasons=False):
     playerStats.write("</tbody></table>")
 
 # Batting stats by DismissalBreakdown
+@profiled()
 def stats_Batting_DismissalBreakdown(playerID):
     
     accordionHelperStart("Dismissal Breakdown", showAll)
@@ -617,8 +544,9 @@ def percentageHelper(smallNumber, bigNumber):
         return "N/A"
 
 # Batting stats by Batting Position
+@profiled()
 def stats_Batting_Position(playerID):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
 
     #playerStats.write('<br><br>')
     #playerStats.write('<div class="card">')
@@ -627,7 +555,9 @@ def stats_Batting_Position(playerID):
     playerStats.write('<div class="p-3 table-responsive">')
     playerStats.write('<table class="table table-bordered table-sm caption-top">')
     
-    inningsList = dbQuery(playerDB, "SELECT * FROM Batting WHERE Position IN (1,2)") 
+    innings = loadPlayerSnapshot(playerID)["Batting"]
+
+    inningsList = selectRows(innings, isIn(innings["Position"], (1,2)))
 
     headers, stats = getBattingStats(inningsList)
 
@@ -636,14 +566,14 @@ def stats_Batting_Position(playerID):
     printStats(False, ("Opening",)+stats, "H",True)
 
     for i in range(3,12):
-        inningsList = dbQuery(playerDB, "SELECT * FROM Batting WHERE Position="+str(i)) 
+        inningsList = selectRows(innings, innings["Position"] == i)
         headers, stats = getBattingStats(inningsList)
         printStats(False, ("# " + str(i),)+stats, "H",True)
 
     playerStats.write("</tbody></table>")
 
     # Get Average Batting Position
-    abp = dbQuery(playerDB, "SELECT AVG(Cast(Position as Float)) From Batting")[0][0]#SUM(Position)
+    abp = cachedQuery(playerDB, "SELECT AVG(Cast(Position as Float)) From Batting")[0][0]#SUM(Position)
     abpString = "N/A"
     if abp != None:
         abpString = str( round(abp,2) )
@@ -657,7 +587,7 @@ def stats_Batting_Position(playerID):
     # Get Mode Batting Position
     posString = ""
     if abp != None:
-        posList = dbQuery(playerDB, "SELECT Position From Batting")
+        posList = cachedQuery(playerDB, "SELECT Position From Batting")
         formattedPosList = [ i[0] for i in posList ]
         # Replace 1 and 2 with "Opening"
         fixedForOpeningList = ["Opening" if x<3 else x for x in formattedPosList]
@@ -670,12 +600,13 @@ def stats_Batting_Position(playerID):
     accordionHelperEnd()
 
 # Batting stats by Bingo - Output a colour coded bingo table of scores a player as made
+@profiled()
 def stats_Batting_Bingo(playerID):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
 
     accordionHelperStart("Batting Bingo", showAll)
 
-    bingoList = dbQuery(playerDB, "SELECT DISTINCT Runs FROM Batting ORDER BY Runs ASC")
+    bingoList = cachedQuery(playerDB, "SELECT DISTINCT Runs FROM Batting ORDER BY Runs ASC")
 
     formattedBingoList = [ i[0] for i in bingoList ]
 
@@ -702,17 +633,14 @@ def stats_Batting_Bingo(playerID):
 # Or maybe show every 10 runs? 0,1,10,20 etc
 # Probably not point showing it past 50 tbh
 # Batting stats by NohitBrohitLine
+@profiled()
 def stats_Batting_NohitBrohitLine(playerID):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
 
     caption = "Nohit/Brohit Line"
 
     discipline = "Batting"
 
-    highScore = dbQuery(playerDB, "SELECT max(Runs) FROM Batting")[0][0]
-
-    scoreList = dbQuery(playerDB, "SELECT DISTINCT Runs FROM Batting ORDER BY Runs ASC")
-    formattedscoreList = [ i[0] for i in scoreList ]
+    innings = loadPlayerSnapshot(playerID)["Batting"]
 
     stepList = [0,1,10,20,30,40,50]
 
@@ -720,7 +648,7 @@ def stats_Batting_NohitBrohitLine(playerID):
     for i in stepList:#range(0, highScore):
         #if i in formattedscoreList:
 
-        inningsList = dbQuery(playerDB, "SELECT * FROM Batting WHERE Runs >= " + str(i) )
+        inningsList = selectRows(innings, innings["Runs"] >= i)
 
         multiLineDisciplineHelper(discipline, inningsList, "Score >=", str(i), indexCount, caption, "brohit")
 
@@ -736,37 +664,36 @@ def stats_Batting_NohitBrohitLine(playerID):
 
 def bowlingWorkloadHelper(playerID, numSeasons=False):
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
 
     if numSeasons:
 
         matchList = []
 
-        seasonList = dbQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
+        seasonList = cachedQuery(playerDB, "SELECT DISTINCT Season FROM Matches")
 
         for season in sorted(seasonList)[-numSeasons:]:
 
-            matchList += dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
+            matchList += cachedQuery(playerDB, "SELECT MatchID FROM Matches WHERE Season='" + season[0] + "'")
             formattedMatchList = "(" + ','.join( [str( i[0] ) for i in matchList] ) + ")"
 
-        overs = dbQuery(playerDB, "SELECT SUM(Cast(Overs as Int)) FROM Bowling WHERE MatchID IN " + formattedMatchList)[0][0]
-        innings = dbQuery(playerDB, "SELECT COUNT(Cast(Overs as Int)) FROM Bowling WHERE MatchID IN " + formattedMatchList)[0][0]
-        maxOvers = dbQuery(playerDB, "SELECT Max(Cast(Overs as Int)) FROM Bowling WHERE MatchID IN " + formattedMatchList)[0][0]
+        balls, innings, maxBalls = cachedQuery(playerDB, "SELECT SUM(Balls), COUNT(Balls), MAX(Balls) FROM Bowling WHERE MatchID IN " + formattedMatchList)[0]
         games = len(matchList)
 
 
     else:
-        overs = dbQuery(playerDB, "SELECT SUM(Cast(Overs as Int)) FROM Bowling")[0][0]
-        innings = dbQuery(playerDB, "SELECT COUNT(Cast(Overs as Int)) FROM Bowling")[0][0]
-        maxOvers = dbQuery(playerDB, "SELECT Max(Cast(Overs as Int)) FROM Bowling")[0][0]
-        games = dbQuery(playerDB, "SELECT NumMatches FROM PlayerInfo")[0][0]
+        balls, innings, maxBalls = cachedQuery(playerDB, "SELECT SUM(Balls), COUNT(Balls), MAX(Balls) FROM Bowling")[0]
+        games = cachedQuery(playerDB, "SELECT NumMatches FROM PlayerInfo")[0][0]
 
-    if overs:
+    if balls:
+        overs = balls / 6
         opg = round(overs/games ,2)
         opi = round(overs/innings,2)
+        maxOvers = ballsToOvers(maxBalls)
     else:
         opg = "N/A"
         opi = "N/A"
+        maxOvers = None
 
     playerStats.write("<p>")
 
@@ -780,6 +707,7 @@ def bowlingWorkloadHelper(playerID, numSeasons=False):
 # Scrap this and bring these stats into Discipline Helper?
 # Would allow viewing these stats for recent/season/grade etc
 # Bowling Workload stats - FIX THIS FOR HTML OUTPUT
+@profiled()
 def stats_Bowling_Workload(playerID):
 
     accordionHelperStart("Bowling - Overs Bowled Per Game", showAll) 
@@ -800,15 +728,19 @@ def stats_Bowling_Workload(playerID):
 ## Graphs
 
 # Calculate/Graph Batting - Running Average and TIRA (Twenty Innings Running Average)
+@profiled()
 def stats_Batting_Graphs(playerID):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    plt = getPyplot()
+    from numpy import nan, arange
+
+    playerDB = getPlayerDB(playerID)
 
     createDirectory("Player Stats/images")
     imageFileName = "images/" + str(playerID) + '-Batting.png'
 
     caption = "Batting Graphs"
 
-    inningsList = dbQuery(playerDB,"SELECT * FROM "+ "Batting")
+    inningsList = cachedQuery(playerDB,"SELECT * FROM "+ "Batting")
 
     playerStats.write('<div class="accordion-item">')
 
@@ -929,7 +861,8 @@ def stats_Batting_Graphs(playerID):
         plt.xlim(xmin=0, xmax=inningsCount+1)
         plt.ylim(ymin=0, ymax=highScore+10)
 
-        plt.savefig('Player Stats/'+imageFileName)
+        with timed("savefig"):
+            plt.savefig('Player Stats/'+imageFileName)
 
         plt.close('all')
 
@@ -944,16 +877,19 @@ def stats_Batting_Graphs(playerID):
     accordionHelperEnd()
 
 # Calculate/Graph Bowling - Running Average and TIRA (Twenty Innings Running Average)
+@profiled()
 def stats_Bowling_Graphs(playerID):
+    plt = getPyplot()
+    from numpy import nan, arange
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
 
     createDirectory("Player Stats/images")
     imageFileName = "images/" + str(playerID) + '-Bowling.png'
 
     caption = "Bowling Graphs"
 
-    inningsList = dbQuery(playerDB,"SELECT * FROM "+ "Bowling")
+    inningsList = cachedQuery(playerDB,"SELECT * FROM "+ "Bowling")
 
     playerStats.write('<div class="accordion-item">')
 
@@ -1082,7 +1018,8 @@ def stats_Bowling_Graphs(playerID):
         plt.xlim(xmin=0, xmax=inningsCount+1)
         plt.ylim(ymin=0, ymax=maxGraphHeight+5)
 
-        plt.savefig('Player Stats/'+imageFileName)
+        with timed("savefig"):
+            plt.savefig('Player Stats/'+imageFileName)
 
         plt.close('all')
 
@@ -1223,6 +1160,7 @@ document.addEventListener("keydown", function(){
     #playerStats.write("""\n</div></div></main></body></html>""")
 
 
+@profiled()
 def rebuildIndex():
 
     now = datetime.now()
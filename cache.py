@@ -0,0 +1,208 @@
+#!python3
+###############################################################################
+# cache.py - On disk cache of fetched pages for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import os, json, time, hashlib, threading
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Use the page cache at all
+useCache = True
+
+cacheDirectory = "Page Cache"
+
+# Once the cached pages add up to more than this, the least recently used are deleted
+cacheMaxBytes = 512 * 1024 * 1024
+
+# Eviction goes down to this fraction of cacheMaxBytes, so there's room for a good number of pages before the next one is needed
+cacheEvictTo = 0.8
+
+# Pages no entry points to are only swept up once they are this many seconds old. storePage writes a page before its entry, outside cacheLock,
+# so a newer one may have its entry on the way
+orphanGracePeriod = 60
+
+###############################################################################
+# Functions
+# Each url gets an entry, "entries/<hash of url>.json", holding its ETag/Last-Modified and when it was fetched.
+# Page bodies are stored once by the hash of their contents, "pages/<hash of page>.html", so identical pages share a file.
+# Entry files are touched whenever they are used, so their modified time tracks least recently used for eviction.
+
+# Total size of the cached pages. Worked out on first use, then kept up to date as pages are added
+cacheBytes = None
+
+cacheLock = threading.Lock()
+
+def hashString(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def getEntryPath(url):
+    return os.path.join(cacheDirectory, "entries", hashString(url) + ".json")
+
+def getPagePath(pageHash):
+    return os.path.join(cacheDirectory, "pages", pageHash + ".html")
+
+# Writes a file so that it's either fully there or not at all, even with other threads or processes reading it
+def writeFileAtomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    with open(tempPath, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tempPath, path)
+
+# Returns the cache entry for a url, with the page text under "text". None if it isn't cached
+def getCachedPage(url):
+
+    entryPath = getEntryPath(url)
+
+    try:
+        with open(entryPath, encoding="utf-8") as f:
+            entry = json.load(f)
+        with open(getPagePath(entry["page"]), encoding="utf-8") as f:
+            entry["text"] = f.read()
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # Mark as recently used
+    try:
+        os.utime(entryPath)
+    except OSError:
+        pass
+
+    return entry
+
+# Whether a cache entry is less than ttl seconds old
+def isFresh(entry, ttl):
+    return (time.time() - entry["fetched"]) < ttl
+
+# Headers that ask the server to only send the page if it has changed since the cached copy
+def getConditionalHeaders(entry):
+
+    headers = {}
+
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lastModified"):
+            headers["If-Modified-Since"] = entry["lastModified"]
+
+    return headers
+
+# Saves a freshly fetched page to the cache
+def storePage(url, text, headers):
+    global cacheBytes
+
+    pageHash = hashString(text)
+    pagePath = getPagePath(pageHash)
+
+    newBytes = 0
+    if not os.path.exists(pagePath):
+        writeFileAtomic(pagePath, text)
+        newBytes = os.path.getsize(pagePath)
+
+    entry = {
+        "url": url,
+        "page": pageHash,
+        "etag": headers.get("ETag"),
+        "lastModified": headers.get("Last-Modified"),
+        "fetched": time.time(),
+    }
+    writeFileAtomic(getEntryPath(url), json.dumps(entry))
+
+    with cacheLock:
+        if cacheBytes is None:
+            cacheBytes = getCacheSize()
+        else:
+            cacheBytes += newBytes
+        overLimit = cacheBytes > cacheMaxBytes
+
+    if overLimit:
+        evictPages()
+
+# Server said the page hasn't changed (304). Resets the entry's fetched time, so it's fresh again
+def refreshPage(url, entry):
+    entry = dict(entry)
+    entry.pop("text", None)
+    entry["fetched"] = time.time()
+    writeFileAtomic(getEntryPath(url), json.dumps(entry))
+
+# Total size of the cached pages
+def getCacheSize():
+
+    pagesDirectory = os.path.join(cacheDirectory, "pages")
+    if not os.path.isdir(pagesDirectory):
+        return 0
+
+    return sum( entry.stat().st_size for entry in os.scandir(pagesDirectory) if entry.is_file() )
+
+# Deletes the least recently used entries until the cache is down to cacheEvictTo of cacheMaxBytes, then any pages no entry points to
+def evictPages():
+    global cacheBytes
+
+    with cacheLock:
+
+        targetBytes = cacheMaxBytes * cacheEvictTo
+
+        # Pages newer than this with no entry may have their entry still being written
+        sweepBefore = time.time() - orphanGracePeriod
+
+        entriesDirectory = os.path.join(cacheDirectory, "entries")
+        pagesDirectory = os.path.join(cacheDirectory, "pages")
+        if not os.path.isdir(entriesDirectory):
+            return
+
+        # Least recently used first
+        entries = sorted( os.scandir(entriesDirectory), key=lambda e: e.stat().st_mtime )
+
+        pageSizes = {}
+        entryPages = []
+        for entry in entries:
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    pageHash = json.load(f)["page"]
+            except (OSError, ValueError, KeyError):
+                os.remove(entry.path)
+                continue
+            entryPages.append( (entry.path, pageHash) )
+            if pageHash not in pageSizes:
+                try:
+                    pageSizes[pageHash] = os.path.getsize(getPagePath(pageHash))
+                except OSError:
+                    pageSizes[pageHash] = 0
+
+        # Number of entries still pointing at each page
+        pageUsers = {}
+        for entryPath, pageHash in entryPages:
+            pageUsers[pageHash] = pageUsers.get(pageHash, 0) + 1
+
+        totalBytes = sum(pageSizes.values())
+
+        for entryPath, pageHash in entryPages:
+            if totalBytes <= targetBytes:
+                break
+            os.remove(entryPath)
+            pageUsers[pageHash] -= 1
+            if pageUsers[pageHash] == 0:
+                totalBytes -= pageSizes[pageHash]
+
+        # Delete pages nothing points to any more
+        for page in os.scandir(pagesDirectory):
+            if page.name.endswith(".html") and pageUsers.get(page.name[:-5], 0) == 0:
+                try:
+                    if page.name[:-5] not in pageSizes and page.stat().st_mtime >= sweepBefore:
+                        totalBytes += page.stat().st_size
+                        continue
+                    os.remove(page.path)
+                except OSError:
+                    pass
+
+        cacheBytes = totalBytes
+
+        if debug:
+            print("Page cache evicted down to " + str(totalBytes) + " bytes")
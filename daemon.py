@@ -0,0 +1,178 @@
+#!python3
+###############################################################################
+# daemon.py - Long running refresh scheduler for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import os, json, time, heapq, random
+
+import fetch
+
+from database import dbQuery, getPlayerDB, closeDatabase
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Seconds between refreshes of a player who is active, has played in the newest season any of our players have
+activeInterval = 15 * 60
+
+# Seconds between refreshes of everyone else
+normalInterval = 24 * 60 * 60
+
+# A player whose match count hasn't changed in this many seconds is taken to be retired, and refreshed every retiredInterval instead
+retiredAfter = 90 * 24 * 60 * 60
+
+retiredInterval = 7 * 24 * 60 * 60
+
+# Seconds before trying a player again after their refresh failed
+errorInterval = 60 * 60
+
+# Each refresh is moved by up to this fraction of its interval, either way, so players that started together drift apart
+intervalJitter = 0.1
+
+# Seconds a cached copy of a current page (player page, season list, latest season) is used for while running as the daemon. Replaces
+# fetch.currentPageTTL, which is longer than activeInterval. 0 asks the site on every refresh, with a conditional GET, so unchanged pages stay cheap
+refreshPageTTL = 0
+
+# Fewest seconds between starting two refreshes, however far behind the schedule is. Keeps catching up from turning into a burst
+minRefreshGap = 10
+
+# When each player was last refreshed, and when their match count last changed. Kept across restarts
+stateFile = "Player Databases/daemon-state.json"
+
+###############################################################################
+# Functions
+# Players wait in a heap ordered by when they are next due. The daemon takes the player due soonest, sleeps until they are due,
+# refreshes them, then puts them back with a new due time going by how active they are.
+
+def loadState():
+    try:
+        with open(stateFile, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveState(state):
+    tempPath = stateFile + ".tmp"
+    with open(tempPath, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tempPath, stateFile)
+
+# Returns (NumMatches, newest Season) for a player, from their database
+def getActivity(playerID):
+
+    playerDB = getPlayerDB(playerID)
+
+    try:
+        numMatches = dbQuery(playerDB, "SELECT NumMatches FROM PlayerInfo")
+        latestSeason = dbQuery(playerDB, "SELECT MAX(Season) FROM Matches")
+    except Exception:
+        return None, None
+    finally:
+        closeDatabase(playerDB)
+
+    return (numMatches[0][0] if numMatches else None), latestSeason[0][0]
+
+# Seconds until a player should next be refreshed, going by their state
+def getInterval(playerState, currentSeason, now):
+
+    if playerState.get("failed"):
+        return errorInterval
+
+    if currentSeason is not None and playerState.get("latestSeason") == currentSeason:
+        return activeInterval
+
+    if now - playerState.get("changed", now) >= retiredAfter:
+        return retiredInterval
+
+    return normalInterval
+
+def jitter(interval):
+    return interval * random.uniform(1 - intervalJitter, 1 + intervalJitter)
+
+# Refreshes players forever, each as often as their activity calls for
+# refreshPlayer - Function taking a player ID, that fetches and rebuilds that player. Anything it raises is caught and the player tried again later
+# onIdle - Optional function called whenever the daemon is about to sleep, e.g. to rebuild the index page after a batch of refreshes
+def runDaemon(playerIDList, refreshPlayer, onIdle=None):
+
+    # Otherwise most refreshes of active players would be served from the page cache, and never see new matches
+    fetch.currentPageTTL = min(fetch.currentPageTTL, refreshPageTTL)
+
+    state = loadState()
+    now = time.time()
+
+    # Newest season any of our players have played in. Anyone who has played in it is active
+    currentSeason = max( [ s["latestSeason"] for s in state.values() if s.get("latestSeason") ], default=None )
+
+    schedule = []
+    for playerID in playerIDList:
+        playerState = state.get(str(playerID))
+
+        if playerState is None:
+            # Never refreshed, so due now
+            due = now
+        else:
+            due = playerState["refreshed"] + getInterval(playerState, currentSeason, now)
+
+        heapq.heappush(schedule, (due, playerID))
+
+    print("Daemon scheduling " + str(len(schedule)) + " players")
+
+    lastStart = 0
+    refreshedSinceIdle = False
+
+    while schedule:
+
+        due, playerID = heapq.heappop(schedule)
+
+        wait = max(due - time.time(), lastStart + minRefreshGap - time.time())
+        if wait > 0:
+            if onIdle and refreshedSinceIdle:
+                onIdle()
+                refreshedSinceIdle = False
+            if debug:
+                print("Next refresh is player " + str(playerID) + " in " + str(round(wait)) + " seconds")
+            time.sleep(wait)
+
+        lastStart = time.time()
+
+        playerState = state.setdefault(str(playerID), {})
+        oldNumMatches = playerState.get("numMatches")
+
+        try:
+            refreshPlayer(playerID)
+            playerState["failed"] = False
+        except fetch.CircuitOpenError as e:
+            # The site is down, not this player. Wait it out, then try them again
+            print(str(e) + ". Waiting " + str(fetch.breakerCooldown) + " seconds")
+            heapq.heappush(schedule, (due, playerID))
+            time.sleep(fetch.breakerCooldown)
+            continue
+        except Exception as e:
+            print("Refreshing player " + str(playerID) + " failed: " + str(e))
+            playerState["failed"] = True
+
+        now = time.time()
+        refreshedSinceIdle = True
+
+        numMatches, latestSeason = getActivity(playerID)
+        if numMatches != oldNumMatches or "changed" not in playerState:
+            playerState["changed"] = now
+        playerState["numMatches"] = numMatches
+        playerState["latestSeason"] = latestSeason
+        playerState["refreshed"] = now
+
+        if latestSeason and (currentSeason is None or latestSeason > currentSeason):
+            currentSeason = latestSeason
+
+        saveState(state)
+
+        interval = getInterval(playerState, currentSeason, now)
+        heapq.heappush(schedule, (now + jitter(interval), playerID))
+
+        if debug:
+            print("Player " + str(playerID) + " refreshed, next in " + str(round(interval / 60)) + " minutes")
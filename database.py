@@ -6,7 +6,12 @@
 ###############################################################################
 # Imports
 
-import os, sqlite3
+import os, sqlite3, threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from profiler import profiled
 
 ###############################################################################
 # User Input / Config
@@ -15,6 +20,28 @@ debug = False
 
 verbose = False
 
+dbDebug = False
+
+# Number of prepared statements sqlite keeps cached per connection
+statementCacheSize = 256
+
+# Max number of query results kept by cachedQuery, across all databases
+queryCacheSize = 2048
+
+# Open databases in WAL mode, so pages can be generated from one process while another is still fetching
+walMode = True
+
+# Seconds to wait on a locked database before giving up
+busyTimeout = 30
+
+# Store every player in one shared warehouse database, instead of one database file per player
+useWarehouse = False
+
+warehouseDB = "Player Databases/warehouse.db"
+
+# Parsed scorecards, shared by every player. Each match's scorecard only needs fetching once, however many of our players played in it
+scorecardDB = "Player Databases/scorecards.db"
+
 ###############################################################################
 # DB Schemas
 
@@ -31,16 +58,167 @@ matchesTable = "Matches (MatchID INTEGER PRIMARY KEY, ClubID INTEGER, Season TEX
 battingTable = "Batting (BattingInningsID TEXT PRIMARY KEY, MatchID INTEGER, Innings INTEGER, Runs INTEGER, Position INTEGER, HowDismissed TEXT, Fours INTEGER, Sixes INTEGER, TeamWicketsLost INTEGER, TeamScore INTEGER, TeamOversFaced TEXT, FOREIGN KEY (MatchID) REFERENCES Matches(MatchID))"
 
 # Changing BowlingInningsID from IntegerPK  to TextPK. Will be MatchID+Innings (ABCD)
+# Balls INTEGER is added on the end by migration 2
 bowlingTable = "Bowling (BowlingInningsID TEXT PRIMARY KEY, MatchID INTEGER, Innings INTEGER, Overs TEXT, Wickets INTEGER, Runs INTEGER, Maidens INTEGER, FOREIGN KEY (MatchID) REFERENCES Matches(MatchID))"
 
 fieldingTable = "Fielding (FieldingInningsID INTEGER PRIMARY KEY, MatchID INTEGER, Catches INTEGER, RunOuts INTEGER, FOREIGN KEY (MatchID) REFERENCES Matches(MatchID))"
 
+# One row per (club, season) page. ListHash - The seasons row on the season list page. ContentHash - The match rows on the season page
+# ContentHash includes the include*Comps settings from fetch.py, so changing those rewrites every season. Added by migration 3
+# Filters (the include*Comps settings the season was written with) is added by migration 5. Until then they were part of ListHash too
+seasonWatermarksTable = "SeasonWatermarks (ClubID INTEGER, SeasonID TEXT, Season TEXT, ListHash TEXT, MatchCount INTEGER, LastMatchID INTEGER, ContentHash TEXT, PRIMARY KEY (ClubID, SeasonID))"
+
+# Which version of each match's scorecard has been applied to this players rows. Fetched - Scorecards.Fetched of the version applied
+# Kept per player, not on Matches, since Matches rows are shared between players in the warehouse. Added by migration 4
+appliedScorecardsTable = "AppliedScorecards (MatchID INTEGER PRIMARY KEY, Fetched REAL, Final INTEGER)"
+
 # Not Yet Implemented
 
 teamMatesTable = "TeamMates (PlayerID INTEGER PRIMARY KEY, FirstName TEXT, LastName Text)"
 
 teamMatesMatchesTable = "TeamMatesMatches (MatchID INTEGER, PlayerID INTEGER, FOREIGN KEY (MatchID) REFERENCES Matches(MatchID), FOREIGN KEY (PlayerID) REFERENCES TeamMates(PlayerID))"
 
+###############################################################################
+# Warehouse Schemas
+# Same columns as the per player tables above, in the same order, but keyed by PlayerID.
+# Matches and Clubs are shared between players, and linked to each player through WarehousePlayerMatches and WarehousePlayerClubs
+
+warehousePlayerInfoTable = "WarehousePlayerInfo (PlayerID INTEGER PRIMARY KEY, FirstName TEXT, LastName TEXT, NumMatches INTEGER)"
+
+warehouseClubsTable = "WarehouseClubs (ClubID INTEGER PRIMARY KEY, ClubName TEXT)"
+
+warehousePlayerClubsTable = "WarehousePlayerClubs (PlayerID INTEGER, ClubID INTEGER, PRIMARY KEY (PlayerID, ClubID))"
+
+warehouseMatchesTable = "WarehouseMatches (MatchID INTEGER, ClubID INTEGER, Season TEXT, Round INTEGER, Grade TEXT, Opponent TEXT, Ground TEXT, HomeOrAway TEXT, WinOrLoss TEXT, FullScorecardAvailable TEXT, Captain TEXT, PRIMARY KEY (MatchID, ClubID))"
+
+warehousePlayerMatchesTable = "WarehousePlayerMatches (PlayerID INTEGER, MatchID INTEGER, ClubID INTEGER, PRIMARY KEY (PlayerID, MatchID))"
+
+warehouseBattingTable = "WarehouseBatting (PlayerID INTEGER, BattingInningsID TEXT, MatchID INTEGER, Innings INTEGER, Runs INTEGER, Position INTEGER, HowDismissed TEXT, Fours INTEGER, Sixes INTEGER, TeamWicketsLost INTEGER, TeamScore INTEGER, TeamOversFaced TEXT, PRIMARY KEY (PlayerID, BattingInningsID))"
+
+warehouseBowlingTable = "WarehouseBowling (PlayerID INTEGER, BowlingInningsID TEXT, MatchID INTEGER, Innings INTEGER, Overs TEXT, Wickets INTEGER, Runs INTEGER, Maidens INTEGER, PRIMARY KEY (PlayerID, BowlingInningsID))"
+
+warehouseFieldingTable = "WarehouseFielding (PlayerID INTEGER, FieldingInningsID INTEGER, MatchID INTEGER, Catches INTEGER, RunOuts INTEGER, PRIMARY KEY (PlayerID, FieldingInningsID))"
+
+warehouseSeasonWatermarksTable = "WarehouseSeasonWatermarks (PlayerID INTEGER, ClubID INTEGER, SeasonID TEXT, Season TEXT, ListHash TEXT, MatchCount INTEGER, LastMatchID INTEGER, ContentHash TEXT, PRIMARY KEY (PlayerID, ClubID, SeasonID))"
+
+warehouseAppliedScorecardsTable = "WarehouseAppliedScorecards (PlayerID INTEGER, MatchID INTEGER, Fetched REAL, Final INTEGER, PRIMARY KEY (PlayerID, MatchID))"
+
+# Per player view name -> (Warehouse table holding the rows, with a PlayerID column, Key columns)
+warehousePlayerViews = {
+    "PlayerInfo": ("WarehousePlayerInfo", ("PlayerID",)),
+    "Batting": ("WarehouseBatting", ("BattingInningsID",)),
+    "Bowling": ("WarehouseBowling", ("BowlingInningsID",)),
+    "Fielding": ("WarehouseFielding", ("FieldingInningsID",)),
+    "SeasonWatermarks": ("WarehouseSeasonWatermarks", ("ClubID", "SeasonID")),
+    "AppliedScorecards": ("WarehouseAppliedScorecards", ("MatchID",)),
+}
+
+# Per player view name -> (Shared warehouse table, Table linking it to players, Key columns)
+warehouseSharedViews = {
+    "Clubs": ("WarehouseClubs", "WarehousePlayerClubs", ("ClubID",)),
+    "Matches": ("WarehouseMatches", "WarehousePlayerMatches", ("MatchID", "ClubID")),
+}
+
+###############################################################################
+# Scorecard Schemas
+# Shared scorecard cache, in scorecardDB. Rows are keyed by the TeamInnings they appear in, numbered in order down the scorecard
+
+# Available - 0 if the match has no full scorecard (yet)
+# FirstFetched, Final are added by scorecard migration 1. Final - 1 once the scorecard can't change any more, so it isn't fetched again. See fetchScorecards
+scorecardsTable = "Scorecards (MatchID INTEGER PRIMARY KEY, Available INTEGER, Fetched REAL)"
+
+scorecardInningsTable = "ScorecardInnings (MatchID INTEGER, TeamInnings INTEGER, Team TEXT, TeamScore INTEGER, TeamWicketsLost INTEGER, TeamOversFaced TEXT, PRIMARY KEY (MatchID, TeamInnings))"
+
+scorecardBattingTable = "ScorecardBatting (MatchID INTEGER, TeamInnings INTEGER, PlayerID INTEGER, Position INTEGER, Runs INTEGER, HowDismissed TEXT, Fours INTEGER, Sixes INTEGER, PRIMARY KEY (MatchID, TeamInnings, PlayerID))"
+
+scorecardFieldingTable = "ScorecardFielding (MatchID INTEGER, TeamInnings INTEGER, PlayerID INTEGER, Catches INTEGER, RunOuts INTEGER, PRIMARY KEY (MatchID, TeamInnings, PlayerID))"
+
+###############################################################################
+# Schema Migrations
+# Each entry is the list of statements that upgrades a database from the previous version. They are applied in order by migrateDatabase,
+# which tracks the current version in PRAGMA user_version. Tables are always created from the schemas above and then migrated,
+# so only ever add new entries to the end of these lists, never edit old ones.
+
+# SQL version of oversToBalls, for backfilling. "3.4" -> 3*6 + 4
+oversToBallsSQL = "CASE WHEN instr(Overs, '.') > 0 THEN CAST(substr(Overs, 1, instr(Overs, '.') - 1) AS INTEGER) * 6 + CAST(substr(Overs, instr(Overs, '.') + 1) AS INTEGER) ELSE CAST(Overs AS INTEGER) * 6 END"
+
+playerMigrations = [
+    # 1 - Indexes on the columns analysis filters Matches by, and joins Batting/Bowling/Fielding on
+    [
+        "CREATE INDEX IF NOT EXISTS MatchesSeason ON Matches (Season)",
+        "CREATE INDEX IF NOT EXISTS MatchesGrade ON Matches (Grade)",
+        "CREATE INDEX IF NOT EXISTS MatchesClubID ON Matches (ClubID)",
+        "CREATE INDEX IF NOT EXISTS MatchesOpponent ON Matches (Opponent)",
+        "CREATE INDEX IF NOT EXISTS BattingMatchID ON Batting (MatchID)",
+        "CREATE INDEX IF NOT EXISTS BattingPosition ON Batting (Position)",
+        "CREATE INDEX IF NOT EXISTS BattingRuns ON Batting (Runs)",
+        "CREATE INDEX IF NOT EXISTS BowlingMatchID ON Bowling (MatchID)",
+        "CREATE INDEX IF NOT EXISTS FieldingMatchID ON Fielding (MatchID)",
+    ],
+    # 2 - Overs as a whole number of balls, so "3.4" overs can be summed. Replaces the MatchID index with one that also covers Balls
+    [
+        "ALTER TABLE Bowling ADD COLUMN Balls INTEGER",
+        "UPDATE Bowling SET Balls = " + oversToBallsSQL,
+        "DROP INDEX IF EXISTS BowlingMatchID",
+        "CREATE INDEX IF NOT EXISTS BowlingMatchIDBalls ON Bowling (MatchID, Balls)",
+    ],
+    # 3 - What each season looked like when it was last fetched, so unchanged seasons can be skipped
+    [
+        "CREATE TABLE IF NOT EXISTS " + seasonWatermarksTable,
+    ],
+    # 4 - Scorecards applied to this player, replacing FullScorecardAvailable as the record of what the second pass has done
+    [
+        "CREATE TABLE IF NOT EXISTS " + appliedScorecardsTable,
+    ],
+    # 5 - The include*Comps settings, out of ListHash, so changing them re-parses seasons from the page cache instead of asking the site
+    [
+        "ALTER TABLE SeasonWatermarks ADD COLUMN Filters TEXT",
+    ],
+]
+
+warehouseMigrations = [
+    # 1 - Same as above, with PlayerID first since every per player view filters on it
+    [
+        "CREATE INDEX IF NOT EXISTS WarehouseMatchesSeason ON WarehouseMatches (Season)",
+        "CREATE INDEX IF NOT EXISTS WarehouseMatchesGrade ON WarehouseMatches (Grade)",
+        "CREATE INDEX IF NOT EXISTS WarehouseMatchesClubID ON WarehouseMatches (ClubID)",
+        "CREATE INDEX IF NOT EXISTS WarehouseMatchesOpponent ON WarehouseMatches (Opponent)",
+        "CREATE INDEX IF NOT EXISTS WarehouseBattingMatchID ON WarehouseBatting (PlayerID, MatchID)",
+        "CREATE INDEX IF NOT EXISTS WarehouseBattingPosition ON WarehouseBatting (PlayerID, Position)",
+        "CREATE INDEX IF NOT EXISTS WarehouseBattingRuns ON WarehouseBatting (PlayerID, Runs)",
+        "CREATE INDEX IF NOT EXISTS WarehouseBowlingMatchID ON WarehouseBowling (PlayerID, MatchID)",
+        "CREATE INDEX IF NOT EXISTS WarehouseFieldingMatchID ON WarehouseFielding (PlayerID, MatchID)",
+    ],
+    # 2
+    [
+        "ALTER TABLE WarehouseBowling ADD COLUMN Balls INTEGER",
+        "UPDATE WarehouseBowling SET Balls = " + oversToBallsSQL,
+        "DROP INDEX IF EXISTS WarehouseBowlingMatchID",
+        "CREATE INDEX IF NOT EXISTS WarehouseBowlingMatchIDBalls ON WarehouseBowling (PlayerID, MatchID, Balls)",
+    ],
+    # 3
+    [
+        "CREATE TABLE IF NOT EXISTS " + warehouseSeasonWatermarksTable,
+    ],
+    # 4
+    [
+        "CREATE TABLE IF NOT EXISTS " + warehouseAppliedScorecardsTable,
+    ],
+    # 5
+    [
+        "ALTER TABLE WarehouseSeasonWatermarks ADD COLUMN Filters TEXT",
+    ],
+]
+
+scorecardMigrations = [
+    # 1 - When each scorecard was first fetched, and whether it's final. Scorecards fetched before this are checked once more
+    [
+        "ALTER TABLE Scorecards ADD COLUMN FirstFetched REAL",
+        "ALTER TABLE Scorecards ADD COLUMN Final INTEGER",
+        "UPDATE Scorecards SET FirstFetched = Fetched, Final = 0",
+    ],
+]
+
 # Placeholder value for missing information
 unknown = "Unknown"
 
@@ -52,10 +230,43 @@ def createDirectory(d,parent=None):
     if not os.path.exists(d):
         os.mkdir(d)
 
+# Converts overs as written on a scorecard ("3.4" is 3 overs and 4 balls) to a number of balls
+def oversToBalls(overs):
+    whole, dot, balls = str(overs).strip().partition(".")
+    return int(whole or 0) * 6 + int(balls or 0)
+
+# Converts a number of balls back to overs as written on a scorecard. 22 -> "3.4"
+def ballsToOvers(balls):
+    if balls % 6:
+        return str(balls // 6) + "." + str(balls % 6)
+    else:
+        return str(balls // 6)
+
+# Returns the database name used to query a players stats.
+# Either their own database file, or the warehouse with a "#PlayerID" suffix which getConnection turns into a per player view of the warehouse
+def getPlayerDB(playerID):
+    if useWarehouse:
+        return warehouseDB + "#" + str(playerID)
+    else:
+        return "Player Databases/" + str(playerID) + ".db"
+
 # Creates the player database. Specifically the PlayerInfo, Matches, Batting, Bowling and Fielding tables
 def createDatabase(playerID, wipe=False):
     
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
+
+    # Warehouse tables and the players views are created when the connection is opened
+    if useWarehouse:
+        migrateDatabase(playerDB)
+
+        if wipe:
+            if debug:
+                print("Deleting all existing rows for player " + str(playerID))
+
+            with dbTransaction(playerDB):
+                for view in ["PlayerInfo", "Clubs", "Matches", "Batting", "Bowling", "Fielding", "SeasonWatermarks", "AppliedScorecards"]:
+                    dbQuery(playerDB,"DELETE FROM " + view + ";")
+        return
 
     # If Database doesnt exist, create one.
     if not os.path.exists(playerDB):
@@ -71,6 +282,11 @@ def createDatabase(playerID, wipe=False):
         dbQuery(playerDB,"DROP TABLE IF EXISTS Batting;")
         dbQuery(playerDB,"DROP TABLE IF EXISTS Bowling;")
         dbQuery(playerDB,"DROP TABLE IF EXISTS Fielding;")
+        dbQuery(playerDB,"DROP TABLE IF EXISTS SeasonWatermarks;")
+        dbQuery(playerDB,"DROP TABLE IF EXISTS AppliedScorecards;")
+
+        # Indexes went with the tables, so start migrations again from the beginning
+        dbQuery(playerDB,"PRAGMA user_version = 0;")
 
     dbQuery(playerDB,"CREATE TABLE IF NOT EXISTS " + playerInfoTable + ";")
     dbQuery(playerDB,"CREATE TABLE IF NOT EXISTS " + clubsTable + ";")
@@ -79,11 +295,249 @@ def createDatabase(playerID, wipe=False):
     dbQuery(playerDB,"CREATE TABLE IF NOT EXISTS " + bowlingTable + ";")
     dbQuery(playerDB,"CREATE TABLE IF NOT EXISTS " + fieldingTable + ";")
 
+    migrateDatabase(playerDB)
+
+# Creates the shared scorecard database, if it doesn't already exist
+def createScorecardDatabase():
+
+    with dbTransaction(scorecardDB):
+        dbQuery(scorecardDB,"CREATE TABLE IF NOT EXISTS " + scorecardsTable + ";")
+        dbQuery(scorecardDB,"CREATE TABLE IF NOT EXISTS " + scorecardInningsTable + ";")
+        dbQuery(scorecardDB,"CREATE TABLE IF NOT EXISTS " + scorecardBattingTable + ";")
+        dbQuery(scorecardDB,"CREATE TABLE IF NOT EXISTS " + scorecardFieldingTable + ";")
+        dbQuery(scorecardDB,"CREATE INDEX IF NOT EXISTS ScorecardBattingPlayerID ON ScorecardBatting (PlayerID, MatchID);")
+        dbQuery(scorecardDB,"CREATE INDEX IF NOT EXISTS ScorecardFieldingPlayerID ON ScorecardFielding (PlayerID, MatchID);")
+
+    migrateDatabase(scorecardDB)
+
+# Upgrades a database in place to the latest schema version, applying any migrations it hasn't had yet
+def migrateDatabase(database):
+
+    if "#" in str(database):
+        migrations = warehouseMigrations
+    elif database == scorecardDB:
+        migrations = scorecardMigrations
+    else:
+        migrations = playerMigrations
+
+    version = dbQuery(database, "PRAGMA main.user_version;")[0][0]
+
+    for newVersion in range(version + 1, len(migrations) + 1):
+
+        if debug:
+            print("Migrating " + str(database) + " to schema version " + str(newVersion))
+
+        # Each migration, and the version bump that goes with it, either fully applies or not at all
+        with dbTransaction(database):
+            for statement in migrations[newVersion - 1]:
+                dbQuery(database, statement)
+            dbQuery(database, "PRAGMA main.user_version = " + str(newVersion) + ";")
+
+    # The players warehouse views were built from the old columns. Reconnecting rebuilds them
+    if migrations is warehouseMigrations and version < len(migrations):
+        closeDatabase(database)
+
+# Creates the warehouse tables, if they don't already exist
+def createWarehouseTables(conn):
+    for table in [warehousePlayerInfoTable, warehouseClubsTable, warehousePlayerClubsTable, warehouseMatchesTable,
+                  warehousePlayerMatchesTable, warehouseBattingTable, warehouseBowlingTable, warehouseFieldingTable]:
+        conn.execute("CREATE TABLE IF NOT EXISTS " + table + ";")
+
+# Returns the column names of a table, in order
+def getTableColumns(conn, table):
+    return [ row[1] for row in conn.execute("PRAGMA main.table_info(" + table + ")") ]
+
+# Creates temporary views over the warehouse, named and laid out exactly like the per player tables (PlayerInfo, Clubs, Matches, Batting...)
+# so the same queries work against either layout. INSTEAD OF triggers send inserts, updates and deletes on the views to the warehouse tables.
+# Temporary views only exist on this connection, which is why each player gets their own connection
+def createPlayerViews(conn, playerID):
+
+    playerID = int(playerID)
+
+    # PlayerInfo, Batting, Bowling, Fielding, SeasonWatermarks - One row per player, with a PlayerID column
+    for view, (table, keys) in warehousePlayerViews.items():
+
+        columns = getTableColumns(conn, table)
+
+        # Table is added by a migration that hasn't run yet. Its view is created once it has, see migrateDatabase
+        if not columns:
+            continue
+
+        if view == "PlayerInfo":
+            viewColumns = columns
+        else:
+            viewColumns = columns[1:]
+
+        newValues = [ str(playerID) if column == "PlayerID" else "NEW." + column for column in columns ]
+        setValues = [ column + " = NEW." + column for column in viewColumns if column != "PlayerID" and column not in keys ]
+        keyMatch = " AND ".join( [ key + " = OLD." + key for key in keys ] )
+        where = " WHERE PlayerID = " + str(playerID) + " AND " + keyMatch + ";"
+
+        conn.execute("CREATE TEMP VIEW " + view + " AS SELECT " + ", ".join(viewColumns) + " FROM " + table + " WHERE PlayerID = " + str(playerID))
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Insert INSTEAD OF INSERT ON " + view + " BEGIN "
+            "INSERT OR REPLACE INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(newValues) + "); END")
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Update INSTEAD OF UPDATE ON " + view + " BEGIN "
+            "UPDATE " + table + " SET " + ", ".join(setValues) + where + " END")
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Delete INSTEAD OF DELETE ON " + view + " BEGIN "
+            "DELETE FROM " + table + where + " END")
+
+    # Clubs, Matches - Shared between players, linked through a second table
+    for view, (table, linkTable, keys) in warehouseSharedViews.items():
+
+        columns = getTableColumns(conn, table)
+
+        newValues = [ "NEW." + column for column in columns ]
+        setValues = [ column + " = NEW." + column for column in columns if column not in keys ]
+        keyMatch = " AND ".join( [ key + " = OLD." + key for key in keys ] )
+
+        conn.execute("CREATE TEMP VIEW " + view + " AS SELECT " + ", ".join( [ "s." + column for column in columns ] ) +
+            " FROM " + linkTable + " l JOIN " + table + " s USING (" + ", ".join(keys) + ") WHERE l.PlayerID = " + str(playerID))
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Insert INSTEAD OF INSERT ON " + view + " BEGIN "
+            "INSERT OR REPLACE INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(newValues) + "); "
+            "INSERT OR IGNORE INTO " + linkTable + " (PlayerID, " + ", ".join(keys) + ") VALUES (" + str(playerID) + ", " + ", ".join( [ "NEW." + key for key in keys ] ) + "); END")
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Update INSTEAD OF UPDATE ON " + view + " BEGIN "
+            "UPDATE " + table + " SET " + ", ".join(setValues) + " WHERE " + keyMatch + "; END")
+
+        conn.execute("CREATE TEMP TRIGGER " + view + "Delete INSTEAD OF DELETE ON " + view + " BEGIN "
+            "DELETE FROM " + linkTable + " WHERE PlayerID = " + str(playerID) + " AND " + keyMatch + "; END")
+
+# One shot migration of every per player database in "Player Databases" into the warehouse
+def migrateToWarehouse():
+
+    for fileName in sorted(os.listdir("Player Databases")):
+
+        playerID = fileName[:-3]
+        if not (fileName.endswith(".db") and playerID.isdigit()):
+            continue
+
+        if verbose:
+            print("Migrating " + fileName + " into the warehouse")
+
+        # Bring the player database up to date first, so it has every column the warehouse has
+        sourceDB = "Player Databases/" + fileName
+        migrateDatabase(sourceDB)
+        closeDatabase(sourceDB)
+
+        playerDB = warehouseDB + "#" + playerID
+        migrateDatabase(playerDB)
+        conn = getConnection(playerDB)
+        conn.execute("ATTACH DATABASE ? AS source", (sourceDB,))
+
+        try:
+            with dbTransaction(playerDB):
+                for view in ["PlayerInfo", "Clubs", "Matches", "Batting", "Bowling", "Fielding", "SeasonWatermarks", "AppliedScorecards"]:
+
+                    # Only copy columns both sides have, in case the player database predates a schema change
+                    sourceColumns = [ row[1] for row in conn.execute("PRAGMA source.table_info(" + view + ")") ]
+                    viewColumns = [ row[1] for row in conn.execute("PRAGMA temp.table_info(" + view + ")") ]
+                    columns = ", ".join( [ column for column in viewColumns if column in sourceColumns ] )
+
+                    if columns:
+                        conn.execute("INSERT OR REPLACE INTO " + view + " (" + columns + ") SELECT " + columns + " FROM source." + view)
+        finally:
+            conn.execute("DETACH DATABASE source")
+            closeDatabase(playerDB)
+
+# Open connections, keyed by database path. Kept open for the whole run, rather than connecting on every query
+# Each thread gets its own, since an sqlite connection can only be used by the thread that opened it
+threadConnections = threading.local()
+
+def getConnections():
+    if not hasattr(threadConnections, "connections"):
+        threadConnections.connections = {}
+    return threadConnections.connections
+
+# Number of writes made through our own connection to each database. PRAGMA data_version only changes when a different connection commits,
+# so cachedQuery checks both. Also bumped when a connection is closed, since data_version starts over on a new connection
+localChanges = {}
+
+# (thread, database, query, values) -> (version, result). Least recently used first
+# Keyed by thread as well, since each thread has its own connection, and so its own data_version
+queryCache = OrderedDict()
+
+queryCacheLock = threading.Lock()
+
+# Returns the open connection for a database, connecting the first time it is asked for
+def getConnection(database):
+
+    connections = getConnections()
+
+    conn = connections.get(database)
+
+    if conn is None:
+        if debug:
+            print("Opening connection to " + str(database))
+
+        # "warehouse.db#PlayerID" - Connect to the warehouse, and set up that players views
+        path, separator, playerID = str(database).partition("#")
+
+        # isolation_level=None - Each statement commits by itself unless it is inside a dbTransaction block
+        conn = sqlite3.connect(path, timeout=busyTimeout, isolation_level=None, cached_statements=statementCacheSize)
+
+        # WAL - Readers see the last committed data and never block the writer, or each other.
+        # synchronous=NORMAL is safe in WAL mode and skips an fsync on every commit
+        if walMode:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+
+        if separator:
+            createWarehouseTables(conn)
+            createPlayerViews(conn, playerID)
+
+        connections[database] = conn
+
+    return conn
+
+# Closes the connection for a database, if one is open
+def closeDatabase(database):
+
+    conn = getConnections().pop(database, None)
+
+    localChanges[database] = localChanges.get(database, 0) + 1
+
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+# Closes every connection opened by this thread
+def closeAllDatabases():
+    for database in list(getConnections()):
+        closeDatabase(database)
+
+# Groups all queries run inside the with block into one transaction. Commits at the end, or rolls back if anything raises
+# Nested blocks join the outer transaction
+# mode - "IMMEDIATE" takes the write lock straight away, so writers queue on busyTimeout instead of failing part way through.
+#        "DEFERRED" for read only blocks, which then see one consistent snapshot of the database
+@contextmanager
+def dbTransaction(database, mode="IMMEDIATE"):
+
+    conn = getConnection(database)
+
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN " + mode)
+    try:
+        yield conn
+    except:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
 # Runs the supplied query against the specified database
+@profiled()
 def dbQuery(database, query, values=() ):
 
     try:
-        conn = sqlite3.connect(database)
+        conn = getConnection(database)
         c = conn.cursor()
         if len(values) > 0:
             c.execute(query,values)
@@ -92,11 +546,13 @@ def dbQuery(database, query, values=() ):
         else:
             if debug:
                 print("Incorrect arguement for 'values' in function dbQuery")
-        conn.commit()
         returnValue = c.fetchall()
         if dbDebug:
             print(str(c.rowcount) + " rows affected")
-        conn.close()
+        c.close()
+
+        if not query.lstrip().upper().startswith("SELECT"):
+            localChanges[database] = localChanges.get(database, 0) + 1
 
         return returnValue
 
@@ -107,12 +563,63 @@ def dbQuery(database, query, values=() ):
         #print("Values: " + str(values))
         raise Exception("Error in dbQuery")
 
+# Runs the supplied query once for each set of values, in a single transaction
+def dbQueryMany(database, query, valuesList):
+
+    if not valuesList:
+        return
+
+    try:
+        with dbTransaction(database) as conn:
+            c = conn.cursor()
+            c.executemany(query, valuesList)
+            if dbDebug:
+                print(str(c.rowcount) + " rows affected")
+            c.close()
+
+        localChanges[database] = localChanges.get(database, 0) + 1
+
+    except:
+        print("Error in dbQueryMany")
+        print("Database: " + str(database))
+        print("Query: " + str(query))
+        raise Exception("Error in dbQueryMany")
+
+# Returns a value that changes whenever the database does, through our own connection or any other
+def getDataVersion(database):
+    conn = getConnection(database)
+    return (conn.execute("PRAGMA data_version;").fetchone()[0], localChanges.get(database, 0))
+
+# Same as dbQuery, for SELECT queries whose results can be reused. Results are cached until the database changes,
+# either through our own connection or any other, and only the queryCacheSize most recently used results are kept
+def cachedQuery(database, query, values=() ):
+
+    version = getDataVersion(database)
+    key = (threading.get_ident(), database, query, tuple(values))
+
+    with queryCacheLock:
+        cached = queryCache.get(key)
+        if cached is not None and cached[0] == version:
+            queryCache.move_to_end(key)
+            # Copy, so callers can't change the cached result
+            return list(cached[1])
+
+    result = dbQuery(database, query, values)
+
+    with queryCacheLock:
+        queryCache[key] = (version, result)
+        queryCache.move_to_end(key)
+        while len(queryCache) > queryCacheSize:
+            queryCache.popitem(last=False)
+
+    return list(result)
+
 # Get player name from the database
 def getPlayerName(playerID):
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
     
     query = "SELECT FirstName, LastName FROM PlayerInfo"
-    result = dbQuery(playerDB,query)
+    result = cachedQuery(playerDB,query)
 
     fullName = str(result[0][0]) + " " + str(result[0][1])
 
@@ -6,9 +6,26 @@
 ###############################################################################
 # Imports
 
-import requests, bs4, re, time
+import requests, bs4, re, os, time, threading, random, hashlib, queue, multiprocessing
 
-from database import dbQuery
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import cache, fixtures, telemetry
+
+from profiler import profiled, record
+
+# lxml is optional, but parses pages several times faster than html.parser
+try:
+    import lxml
+    lxmlInstalled = True
+except ImportError:
+    lxmlInstalled = False
+
+from database import dbQuery, dbQueryMany, cachedQuery, dbTransaction, getPlayerDB, oversToBalls, closeAllDatabases, createScorecardDatabase, scorecardDB
 
 ###############################################################################
 # User Input / Config
@@ -34,42 +51,430 @@ includeJuniorsComps = False
 
 # TODO Add something to the template(s) listing which comps were included/excluded from data
 
-# Sleep Duration after each HTTP request
+# Sleep Duration after each season page. Only used when rateLimit is 0
 sleepDuration = 1
 
+# Max requests per second to each host, shared between all fetch threads. 0 to turn off and sleep sleepDuration instead
+rateLimit = 1.0
+
+# Number of requests that can go out back to back before rateLimit kicks in
+rateBurst = 2
+
+# Number of pages fetched at once
+fetchWorkers = 4
+
+# Number of processes parsing season pages. 0 to parse in the fetch threads instead
+parseWorkers = os.cpu_count() or 1
+
+# Requests for a page that is already being fetched wait for that fetch, instead of fetching it again. Same for parsing it into a soup
+coalesceRequests = True
+
+# Number of finished pages and soups kept, so repeat requests later in the run are served without fetching or parsing again
+coalesceCacheSize = 128
+
+# Most pages waiting between each stage of the ingest pipeline (fetch, parse, write) before the stage ahead of it waits
+pipelineQueueSize = 32
+
+# Most seasons the writer thread writes in one transaction
+writeBatchSize = 16
+
+# Attempts at fetching a page before giving up with a FetchError
+maxAttempts = 6
+
+# Seconds to wait before retrying. Doubles after each failed attempt, with random jitter, up to backoffMax
+backoffBase = 1
+
+backoffMax = 60
+
+# Seconds to wait for the server to respond
+requestTimeout = 30
+
+# Status codes worth retrying. Anything else in the 4xx range fails straight away
+retryStatusCodes = [408, 429, 500, 502, 503, 504]
+
+# Circuit breaker. After this many failed requests in a row the site is taken to be down, and every fetch fails straight away
+# with a CircuitOpenError, instead of each page retrying maxAttempts times. 0 to turn off
+breakerThreshold = 20
+
+# Seconds the breaker stays open. After that one request is let through to test the site. If it works, fetching carries on as normal
+breakerCooldown = 5 * 60
+
+# Seconds a cached page is used for before checking the site for changes. Past seasons are cached forever, unless their row on the season list changes
+currentPageTTL = 60 * 60
+
+pastSeasonTTL = float("inf")
+
+# BeautifulSoup parser. "lxml" if it's installed, otherwise the slower built in "html.parser"
+parserBackend = "lxml"
+
+# Tags each page parser reads. Everything else on the page is skipped while parsing, so isn't built into the soup. None to parse the whole page
+# Season list - Only reads the season rows
+seasonListParseOnly = ["tr"]
+
+# Season page - Reads the match rows, and the element holding the season name. Add its tag here if it isn't one of these
+seasonPageParseOnly = ["tr", "h1", "h2", "h3", "h4", "span"]
+
+# Page URLs. Fields in {} are filled in for each request
+playerURL = "www.fake-cricket-stats-website.com"
+
+seasonListURL = "www.fake-cricket-stats-website.com"
+
+seasonURL = "www.fake-cricket-stats-website.com"
+
+scorecardURL = "www.fake-cricket-stats-website.com"
+
+# Links to player pages on a scorecard. The one group is the player ID
+playerLinkPattern = r"playerID=(\d+)"
+
+# Scorecard - Only reads the innings tables
+scorecardParseOnly = ["table"]
+
+# Number of scorecards fetched before they are written to the scorecard database, in one transaction
+scorecardBatchSize = 50
+
+# Seconds a scorecard that isn't final yet is used for, before it's fetched again. Scorecards are often uploaded, or filled in, days after the match
+scorecardTTL = 60 * 60
+
+# Seconds after a scorecard is first fetched that it's taken as final, even if it's still missing or incomplete, so it stops being fetched
+scorecardFinalAge = 14 * 24 * 60 * 60
+
 # Placeholder value for missing information
 unknown = "Unknown"
 
 ###############################################################################
 # Functions
 
-# Fetches a url using requests and then extracts the 'soup' for the loaded page
-def getSoup(url):
+# Token buckets for rateLimit. host -> [tokens, last refill time]
+tokenBuckets = {}
+
+tokenBucketLock = threading.Lock()
+
+# Blocks until a request to url's host is allowed under rateLimit
+def waitForToken(url):
+
+    if not rateLimit:
+        return
+
+    host = urlsplit(url).netloc or url.split("/")[0]
+
+    while True:
+        with tokenBucketLock:
+            now = time.monotonic()
+            bucket = tokenBuckets.setdefault(host, [rateBurst, now])
+
+            # Top up for the time since the last request, up to rateBurst
+            bucket[0] = min(rateBurst, bucket[0] + (now - bucket[1]) * rateLimit)
+            bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+
+            wait = (1 - bucket[0]) / rateLimit
+
+        time.sleep(wait)
+
+# Fetches a list of urls, fetchWorkers at a time. Returns the soups in the same order as urls
+# ttls - Optional list of cache times, one for each url. See getPage
+# parseOnly - See getSoup
+def getSoups(urls, ttls=None, parseOnly=None):
+
+    if ttls is None:
+        ttls = [currentPageTTL] * len(urls)
+
+    parseOnlys = [parseOnly] * len(urls)
+
+    if fetchWorkers <= 1 or len(urls) <= 1:
+        return [ getSoup(url, ttl, parseOnly) for url, ttl in zip(urls, ttls) ]
+
+    with ThreadPoolExecutor(max_workers=fetchWorkers) as executor:
+        return list(executor.map(getSoup, urls, ttls, parseOnlys))
+
+# Raised when a page can't be fetched, after retrying maxAttempts times
+class FetchError(Exception):
+    pass
+
+# Raised instead of fetching while the circuit breaker is open
+class CircuitOpenError(FetchError):
+    pass
+
+# Circuit breaker state. Failed requests in a row, and when the breaker opened (None while closed)
+breakerFailures = 0
+
+breakerOpenedAt = None
+
+breakerLock = threading.Lock()
+
+# Raises a CircuitOpenError if the breaker is open. Once breakerCooldown has passed, lets one request through to test the site
+def checkBreaker(url):
+    global breakerOpenedAt
+
+    with breakerLock:
+        if breakerOpenedAt is None:
+            return
+
+        if time.time() - breakerOpenedAt >= breakerCooldown:
+            # Half open. Restart the cooldown, so only this request gets through until it succeeds or fails
+            breakerOpenedAt = time.time()
+            return
+
+    raise CircuitOpenError("Not fetching " + url + ". Too many failed requests in a row, the site looks to be down")
+
+# Records the result of a request for the breaker
+def recordBreakerResult(ok):
+    global breakerFailures, breakerOpenedAt
+
+    with breakerLock:
+        if ok:
+            breakerFailures = 0
+            breakerOpenedAt = None
+            return
+
+        breakerFailures += 1
+        if breakerThreshold and breakerFailures >= breakerThreshold and breakerOpenedAt is None:
+            breakerOpenedAt = time.time()
+            telemetry.count("breakerTrips")
+            print("Circuit breaker open after " + str(breakerFailures) + " failed requests in a row")
+
+# Shared requests session. Keeps connections to the site open between requests, instead of a new TCP/TLS handshake for every page
+session = None
+
+sessionLock = threading.Lock()
+
+def getSession():
+    global session
+
+    with sessionLock:
+        if session is None:
+            session = requests.Session()
+            # Enough pooled connections for every thread fetching at once. In runIngestPipeline that's the fetch threads, plus the feeder's
+            # getSoups threads for season lists. Past that, threads wait for a free connection instead of opening one that's thrown away after.
+            # Retries are handled in getPage
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=2 * max(fetchWorkers, 1), pool_block=True, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+    return session
+
+# Returns the number of seconds a Retry-After header asks us to wait, or None if there isn't a usable one
+def getRetryAfter(res):
+
+    retryAfter = res.headers.get("Retry-After")
+    if not retryAfter:
+        return None
+
+    # Either a number of seconds, or a date
+    try:
+        return max(float(retryAfter), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max((parsedate_to_datetime(retryAfter) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# Seconds to wait before the given retry. Exponential backoff with full jitter, so threads that failed together don't all retry together
+def getBackoff(attempt):
+    return random.uniform(0, min(backoffMax, backoffBase * 2 ** attempt))
+
+# Single flight. key -> Future for the page or soup, finished or still being fetched. Least recently used first
+coalesced = OrderedDict()
+
+coalescedLock = threading.Lock()
+
+# Returns function(*args), unless a call with the same key is already running or has finished recently, in which case that result is shared
+# Only one thread ever runs function for a key at a time. Failures aren't kept, so the next request tries again
+def singleFlight(key, function, *args):
+
+    if not coalesceRequests:
+        return function(*args)
+
+    with coalescedLock:
+        future = coalesced.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            coalesced[key] = future
+        coalesced.move_to_end(key)
+
+        # Only forget finished results. Anything still running has threads waiting on it
+        for oldKey in list(coalesced):
+            if len(coalesced) <= coalesceCacheSize:
+                break
+            if coalesced[oldKey].done():
+                del coalesced[oldKey]
+
+    if not owner:
+        if debug:
+            print("Sharing result for %s" % str(key))
+        return future.result()
+
+    try:
+        result = function(*args)
+    except BaseException as e:
+        with coalescedLock:
+            if coalesced.get(key) is future:
+                del coalesced[key]
+        future.set_exception(e)
+        raise
+
+    future.set_result(result)
+    return result
+
+# Forgets every shared page and soup, so the next request for each goes to the cache or site again
+def clearCoalesced():
+    with coalescedLock:
+        coalesced.clear()
+
+# Returns the page text for a url. Depending on fixtures.fixtureMode, replays it from the fixture store instead of fetching it,
+# or records it there after fetching it
+# ttl - Seconds a cached copy of the page is good for. Once it's older, the site is asked whether it has changed (ETag/Last-Modified)
+#       None for currentPageTTL, as it is when the page is fetched, so it can be changed at runtime. The daemon lowers it to refresh pages
+def getPage(url, ttl=None):
+    if ttl is None:
+        ttl = currentPageTTL
+    # A request that has to ask the site (ttl 0) can't share a result that might have come from the page cache
+    return singleFlight( ("page", url, ttl <= 0), loadPage, url, ttl )
+
+def loadPage(url, ttl=None):
+
+    telemetry.count("pages")
+
+    if fixtures.fixtureMode == "replay":
+        text = fixtures.replayPage(url)
+        if text is None:
+            telemetry.count("failedPages")
+            raise FetchError("No recorded page for " + url + " in " + fixtures.fixtureDirectory)
+        telemetry.count("replayed")
+        return text
+
+    try:
+        text = downloadPage(url, ttl)
+    except FetchError:
+        telemetry.count("failedPages")
+        raise
+
+    if fixtures.fixtureMode == "record":
+        fixtures.recordPage(url, text)
+
+    return text
+
+# Fetches a url and returns the page text. Retries failed requests with exponential backoff, and raises a FetchError once out of attempts
+@profiled("fetch")
+def downloadPage(url, ttl=None):
+
+    if ttl is None:
+        ttl = currentPageTTL
+
+    cached = None
+    if cache.useCache:
+        cached = cache.getCachedPage(url)
+        if cached and cache.isFresh(cached, ttl):
+            if debug:
+                print("Using cached page %s" % url)
+            telemetry.count("cacheHits")
+            return cached["text"]
+
+    attempt = 0
+    while True:
+
+        if debug:
+            print(('Downloading page %s' % url))
+
+        checkBreaker(url)
 
-    attempts = 0
-    while attempts <= 5:
+        waitForToken(url)
+
+        retryAfter = None
         try:
-            a = url
+            startTime = time.perf_counter()
+            try:
+                res = getSession().get(url, timeout=requestTimeout, headers=cache.getConditionalHeaders(cached))
+            except requests.RequestException as e:
+                telemetry.recordRequest(time.perf_counter() - startTime, error=e)
+                recordBreakerResult(False)
+                raise
+            telemetry.recordRequest(time.perf_counter() - startTime, res.status_code, len(res.content))
+
             if debug:
-                    print(('Downloading page %s' % url))
+                print("Returned status code: " + str( res ))
+
+            # Only server errors and throttling count against the breaker. A 404 means the site is up
+            recordBreakerResult(res.status_code < 500 and res.status_code != 429)
+
+            # Not modified, our cached copy is still current
+            if res.status_code == 304 and cached:
+                telemetry.count("notModified")
+                cache.refreshPage(url, cached)
+                return cached["text"]
+
+            if res.status_code in retryStatusCodes:
+                retryAfter = getRetryAfter(res)
+
+            elif 400 <= res.status_code < 500:
+                raise FetchError("Fetching " + url + " failed with status code " + str(res.status_code))
 
-            res = requests.get(a)
             res.raise_for_status()
+
+            if cache.useCache:
+                cache.storePage(url, res.text, res.headers)
+
+            return res.text
+
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt >= maxAttempts:
+                raise FetchError("Fetching " + url + " failed after " + str(attempt) + " attempts") from e
+
+            if retryAfter is None:
+                delay = getBackoff(attempt)
+            else:
+                delay = min(retryAfter, backoffMax)
+
             if debug:
-                print("Returned status code: " + str( res ))
-            soup = bs4.BeautifulSoup(res.text, "html.parser")
-            return soup
+                print("Attempt " + str(attempt) + " failed (" + str(e) + "). Retrying in " + str(round(delay, 2)) + " seconds")
+
+            telemetry.count("retries")
+
+            time.sleep(delay)
+
+# Returns the BeautifulSoup parser to use
+def getParser():
+    if parserBackend == "lxml" and not lxmlInstalled:
+        return "html.parser"
+    return parserBackend
+
+# Turns page text into a soup
+# parseOnly - List of tag names. Only those tags (and everything inside them) are built into the soup
+@profiled("parse")
+def parseSoup(text, parseOnly=None):
+
+    strainer = None
+    if parseOnly:
+        strainer = bs4.SoupStrainer(parseOnly)
+
+    return bs4.BeautifulSoup(text, getParser(), parse_only=strainer)
+
+# Fetches a url and then extracts the 'soup' for the loaded page
+# Repeat requests for the same url and parseOnly share one soup, so callers must not change it
+def getSoup(url, ttl=None, parseOnly=None):
 
-        except Exception:
-            #sleep for a second then try again
-            time.sleep(1)
-            attempts += 1
+    soup = singleFlight( ("soup", url, tuple(parseOnly or ())), loadSoup, url, ttl, parseOnly )
+    return soup
 
+def loadSoup(url, ttl=None, parseOnly=None):
+    return parseSoup(getPage(url, ttl), parseOnly)
 
 # Fetches player info, and populates the PlayerInfo table
 def fetchPlayerInfo(playerID):
+    playerRow, clubRows = parsePlayerInfo(playerID)
+    writePlayerInfo(getPlayerDB(playerID), playerRow, clubRows)
 
-    soup = getSoup( "www.fake-cricket-stats-website.com" )
+# Fetches and parses a players page. Returns (PlayerInfo row, Clubs rows), ready for writePlayerInfo
+def parsePlayerInfo(playerID):
+
+    soup = getSoup( playerURL.format(playerID=playerID) )
 
     # Get Player Name
     fullName = soup.select("#selector")[0].text
@@ -87,60 +492,76 @@ def fetchPlayerInfo(playerID):
     if debug:
         print("Matches played: " + str(numMatches))
 
-    # Insert into PlayerInfo table
-    playerDB = "Player Databases/" + str(playerID) + ".db"
-            
-    query = "INSERT OR IGNORE INTO PlayerInfo (PlayerID, FirstName, LastName, NumMatches) VALUES (?,?,?,?)"
-    values = (playerID, firstName, lastName, numMatches)
-    dbQuery(playerDB,query,values)
-
-    query = "UPDATE PlayerInfo SET NumMatches=? WHERE PlayerID = ?"
-    values = (numMatches, playerID)
-    dbQuery(playerDB,query,values)
-
-    if debug:
-        print("PlayerInfo Table Updated.")
-
     # Get clubs
     clubList = soup.select('selector')
 
     if debug:
         print(clubList)
 
+    clubRows = []
     for thing in clubList:
         if debug:
             print(thing.contents)
-        query = "INSERT OR IGNORE INTO Clubs (ClubID, ClubName) VALUES (?,?)"
-        values = ( thing['value'], thing.contents[0].get_text(strip=True).replace("'","") )
+        # ClubID as a number, the same as it comes back out of the Clubs table
+        clubID = thing['value']
+        if clubID.isdigit():
+            clubID = int(clubID)
+        values = ( clubID, thing.contents[0].get_text(strip=True).replace("'","") )
+        clubRows.append(values)
+
+    return (playerID, firstName, lastName, numMatches), clubRows
+
+# Writes a players PlayerInfo and Clubs rows, in one transaction
+def writePlayerInfo(playerDB, playerRow, clubRows):
+
+    with dbTransaction(playerDB):
+        query = "INSERT OR IGNORE INTO PlayerInfo (PlayerID, FirstName, LastName, NumMatches) VALUES (?,?,?,?)"
+        dbQuery(playerDB,query,playerRow)
+
+        query = "UPDATE PlayerInfo SET NumMatches=? WHERE PlayerID = ?"
+        values = (playerRow[3], playerRow[0])
         dbQuery(playerDB,query,values)
 
+        query = "INSERT OR IGNORE INTO Clubs (ClubID, ClubName) VALUES (?,?)"
+        dbQueryMany(playerDB,query,clubRows)
+
+    if debug:
+        print("PlayerInfo and Clubs Tables Updated.")
+
 # Returns the list of clubIDs for clubs that a player has played for
-def getClubList(playerID):
+# clubRows - Optional Clubs rows not written yet, e.g. from parsePlayerInfo. Included too
+def getClubList(playerID, clubRows=None):
     if debug:
         print("getClubList("+str(playerID)+")")
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+    playerDB = getPlayerDB(playerID)
+
+    clubList = cachedQuery(playerDB, "SELECT * from Clubs")
 
-    clubList = dbQuery(playerDB, "SELECT * from Clubs")
+    if clubRows:
+        clubIDs = [ club[0] for club in clubList ]
+        clubList = list(clubList) + [ club for club in clubRows if club[0] not in clubIDs ]
 
     return clubList
 
 
 # Fetches the list of all of the season a player has played for a club
-def getSeasonList(playerID):#, clubID):
+# Returns (clubID, seasonID, seasonText, listHash, rowText) for each, sorted by season
+# clubRows - See getClubList
+def getSeasonList(playerID, clubRows=None):#, clubID):
 
     if debug:
         print("getSeasonList("+str(playerID)+")")
 
     seasonList = []
 
-    clubList = getClubList(playerID)
+    clubList = getClubList(playerID, clubRows)
 
-    for club in clubList:
+    urls = [ seasonListURL.format(playerID=playerID, clubID=club[0]) for club in clubList ]
 
-        clubID = club[0]
+    for club, soup in zip(clubList, getSoups(urls, parseOnly=seasonListParseOnly)):
 
-        soup = getSoup( "www.fake-cricket-stats-website.com" )
+        clubID = club[0]
 
         childList = soup.find_all('#selector')
 
@@ -160,9 +581,13 @@ def getSeasonList(playerID):#, clubID):
             if ("/" not in text) and (not includeMidYearComps):
                 continue
 
-            if (clubID, seasonID, text) not in seasonList:
+            # Hash of the seasons whole row on the season list. If it hasn't changed since the season was last fetched, neither has the season
+            rowText = seasonRow.get_text("|", strip=True)
+            listHash = getListHash(rowText)
+
+            if (clubID, seasonID, text, listHash, rowText) not in seasonList:
                 # Returning tuple due to season duplication bug
-                seasonList.append( (clubID, seasonID, text) )
+                seasonList.append( (clubID, seasonID, text, listHash, rowText) )
 
     def returnThird(elem):
         return elem[2]          
@@ -173,282 +598,886 @@ def getInningsID(matchID, inningsNum):
     letters = "ZABCD"
     return str(matchID)+letters[inningsNum]
 
-# First pass at populating the player database. Fetches as much information as possible without opening individual scorecard views
-def populateDatabaseFirstPass(playerID, difference=0):
+# Batched writes for populateDatabaseFirstPass
+matchesInsertQuery = "INSERT OR REPLACE INTO Matches (MatchID, ClubID, Season, Round, Grade, Opponent, Ground, HomeOrAway, WinOrLoss, FullScorecardAvailable, Captain ) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+
+battingInsertQuery = "INSERT OR REPLACE INTO Batting (BattingInningsID, MatchID, Innings, Runs, Position, HowDismissed, Fours, Sixes, TeamWicketsLost, TeamScore, TeamOversFaced) VALUES (?,?,?,?,?,?,null,null,null,null,null)"
 
-    seasonList = getSeasonList(playerID)
+bowlingInsertQuery = "INSERT OR REPLACE INTO Bowling (bowlingInningsID, MatchID, Innings, Overs, Wickets, Runs, Maidens, Balls) VALUES (?,?,?,?,?,?,?,?)"
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+# Writes the parsed rows for a season to the player database, in a single transaction
+def writeSeasonRows(playerDB, matchRows, battingRows, bowlingRows):
+
+    with dbTransaction(playerDB):
+        dbQueryMany(playerDB, matchesInsertQuery, matchRows)
+        dbQueryMany(playerDB, battingInsertQuery, battingRows)
+        dbQueryMany(playerDB, bowlingInsertQuery, bowlingRows)
+
+        # The batting rows were just replaced without their scorecard columns, so those matches need their scorecards applied again
+        dbQueryMany(playerDB, "DELETE FROM AppliedScorecards WHERE MatchID = ?", [ (row[0],) for row in matchRows ])
+
+    if debug:
+        print("Wrote " + str(len(matchRows)) + " matches, " + str(len(battingRows)) + " batting and " + str(len(bowlingRows)) + " bowling innings")
+
+# Returns the include*Comps settings as a string. Saved with each watermark, and part of ContentHash, so that changing them re-parses every season
+def getFilterSignature():
+    return str( (includeMidYearComps, includeT20Comps, includeWomensOnlyComps, includeVeteransComps, includeJuniorsComps) )
+
+# Hash of a seasons row on the season list
+# filters - Watermarks from before migration 5 hashed the filter signature in too. Pass it to get the hash the same way
+def getListHash(rowText, filters=None):
+    if filters is not None:
+        rowText = filters + "|" + rowText
+    return hashlib.sha256(rowText.encode("utf-8")).hexdigest()
+
+# Returns the players season watermarks. (ClubID, SeasonID) -> (ListHash, Filters, ContentHash)
+def getWatermarks(playerDB):
+    rows = dbQuery(playerDB, "SELECT ClubID, SeasonID, ListHash, Filters, ContentHash FROM SeasonWatermarks")
+    return { (row[0], row[1]): (row[2], row[3], row[4]) for row in rows }
+
+# Parses a season page. Returns (seasonText, matchRows, battingRows, bowlingRows, contentHash), with rows ready for writeSeasonRows
+def parseSeasonPage(soup, clubID):
+
+    seasonText = soup.select("#selector")[0].get_text(strip=True)
+    #print seasonText
+
+    matches = soup.select("#selector")
+
+    # Rows for this season, written together once the whole page has been parsed
+    matchRows = []
+    battingRows = []
+    bowlingRows = []
 
     matchList = []
 
-    battingInningsID = 1#select (count *) from Batting ?
+    # Hash of every match row on the page, before any are filtered out. Compared against the seasons watermark to tell if anything changed
+    contentHash = hashlib.sha256(getFilterSignature().encode("utf-8"))
 
-    bowlingInningsID = 1 
+    prevMatchInfo = {}
+    #if True:
+    #   match = matches[2]
+    for match in matches:
+        contentHash.update( (match.get('onclick', '') + "|" + match.get_text("|", strip=True) + "\n").encode("utf-8") )
 
-    #clubList = getClubList(playerID)
+        matchOnclickText = match['onclick']
+        #print matchOnclickText
+        matchID = matchOnclickText[7:len(str(matchOnclickText))-2]
 
-    # Small difference, only grab 2 most recent seasons
-    if difference <= 10:
-        seasonList = seasonList[-2:]
+        innings = 0
 
-    # For each season in list, get list of matches, and add them to matchList
-    for clubID, seasonID, seasonText in seasonList:
+        tds = match.select("td")
 
-        # Debugging 2x Last Season bug
-        #print str(club) + ", " + str(season)
-        #continue
-        # End
+        superDebug = False
+        if superDebug:
+            print(str(len(tds)))
+            i = 0
+            for thing in tds:
+                print(str(i) + " : " + str(thing))
+                i += 1
 
-        if 1:
-        #for club in clubList:
+        # Fetch Match Specific Info
 
-            #clubID = str(club)#[0])
-            #print clubID
+        grade = tds[0].get_text(strip=True).replace("'","")
 
-            soup = getSoup( "www.fake-cricket-stats-website.com" )
-    
-            seasonText = soup.select("#selector")[0].get_text(strip=True)
-            #print seasonText
-    
-            matches = soup.select("#selector")
-    
-            prevMatchInfo = {}
-            #if True:
-            #   match = matches[2]
-            for match in matches:
-                matchOnclickText = match['onclick']
-                #print matchOnclickText
-                matchID = matchOnclickText[7:len(str(matchOnclickText))-2]
-    
-                innings = 0
-    
-                tds = match.select("td")
-    
-                superDebug = False
-                if superDebug:
-                    print(str(len(tds)))
-                    i = 0
-                    for thing in tds:
-                        print(str(i) + " : " + str(thing))
-                        i += 1
-    
-                # Fetch Match Specific Info
-    
-                grade = tds[0].get_text(strip=True).replace("'","")
-                
-                if grade == "":
-                    innings = 2
-                    if debug:
-                        print("Multi Innings Match - Fetching Previous Info")
-                    grade = prevMatchInfo['grade']
-                    Round = prevMatchInfo['Round']
-                    opponent = prevMatchInfo['opponent']
-                    ground = prevMatchInfo['ground']
-                    homeOrAway = prevMatchInfo['homeOrAway']
-                    winOrLoss = prevMatchInfo['winOrLoss']
-                    fullScorecardAvailable = prevMatchInfo['fullScorecardAvailable']
-                    captain = prevMatchInfo['captain']
-    
-    
+        if grade == "":
+            innings = 2
+            if debug:
+                print("Multi Innings Match - Fetching Previous Info")
+            grade = prevMatchInfo['grade']
+            Round = prevMatchInfo['Round']
+            opponent = prevMatchInfo['opponent']
+            ground = prevMatchInfo['ground']
+            homeOrAway = prevMatchInfo['homeOrAway']
+            winOrLoss = prevMatchInfo['winOrLoss']
+            fullScorecardAvailable = prevMatchInfo['fullScorecardAvailable']
+            captain = prevMatchInfo['captain']
+
+
+        else:
+            grade = tds[0].get_text(strip=True).replace("'","")
+
+            innings = 1
+
+            Round = tds[1].get_text(strip=True)
+
+            opponent = tds[3].select("span")[0].get_text(strip=True).replace("'","")
+
+            ground = unknown
+
+            homeOrAway = unknown
+            regex = re.findall( r'(red|green)', tds[4].select("img")[0]["src"] )[0]
+            if regex == "green":
+                homeOrAway = "Home"
+            elif regex == "red":
+                homeOrAway = "Away"
+
+            winOrLoss = unknown
+
+            fullScorecardAvailable = unknown
+
+            captain = unknown
+
+        # Fetch Batting Specific Info
+
+        batting = match.select("td.batting")
+
+        if (batting[0].get_text(strip=True) != '') and (batting[1].get_text(strip=True) != '') and (batting[2].get_text(strip=True) != 'dnb'):
+            battingRuns = int(batting[0].get_text(strip=True))
+            battingPos = int(batting[1].get_text(strip=True))
+            battingOut = batting[2].get_text(strip=True)
+
+        # Fetch Bowling Specific Info
+
+        bowling = match.select("td.bowling")
+
+        if bowling[0].get_text(strip=True)!= '':
+
+            bowlingOvers = bowling[0].get_text(strip=True)
+
+            temp = bowling[1].get_text(strip=True)
+
+            if temp != '':
+                bowlingMaidens = int(temp)
+            else:
+                bowlingMaidens = 0
+
+            temp = bowling[2].get_text(strip=True)
+            if temp != '':
+                bowlingWickets = int(temp)
+            else:
+                bowlingWickets = 0
+
+            temp = bowling[3].get_text(strip=True)
+            if temp != '':    
+                bowlingRuns = int(temp)
+            else:
+                if debug:
+                    print("I dont think stats from this match should be included.")
+                bowlingRuns = 0
+
+        # Fetch Fielding Specific Info
+        # len fielding 5
+        # Catches, CatchesWK, RunoutUnassisted, RunoutAssisted, Stumping
+
+        fielding = match.select("td.fielding")
+
+        ### DB Inserts into various tables
+        ##
+        # 
+
+
+        # Comp/Grade Inclusion/Exclusion Checks
+        loweredGradeString = grade.lower()
+        excludedComp = False
+
+        #  T20 Comps
+        if ("t20" in loweredGradeString) and (not includeT20Comps):
+            excludedComp = True
+
+        # Veterans Comps
+        if ("veteran" in loweredGradeString) and (not includeVeteransComps):
+            excludedComp = True
+
+        # Women's Only Comps
+        if ("women" in loweredGradeString) and (not includeWomensOnlyComps):
+            excludedComp = True
+
+        # Juniors Comps
+        juniorStrings = ["under", "u11","u12","u13","u14","u15","u16","u17","u18","u19","u21"]
+        if (not includeJuniorsComps):
+            for js in juniorStrings:
+                if js in loweredGradeString:
+                    excludedComp = True
+                    continue
+
+        if not excludedComp:
+
+            #Matches
+            if matchID not in matchList:
+                # It wont be in DB so insert
+                # Consider changing "INSERT OR IGNORE" to "INSERT OR REPLACE"
+                #query = "INSERT OR IGNORE INTO Matches (MatchID, ClubID, Season, Round, Grade, Opponent, Ground, HomeOrAway, WinOrLoss, FullScorecardAvailable, Captain ) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+                values = (matchID, clubID, seasonText, Round, grade, opponent, ground, homeOrAway, winOrLoss, fullScorecardAvailable, captain)
+                matchRows.append(values)
+
+                matchList.append(matchID)
+
+                # If verbose Print Match Info 
+                if verbose:
+
+                    #Match Info
+                    print("MatchID: " + str(matchID))
+                    print("ClubID: " + str(clubID))
+                    print("Season: " + seasonText)
+                    print("Round: " + str(Round))
+                    print("Grade: " + str(grade))
+                    print("Innings: " + str(innings))# Not in Matches Table
+                    print("Opponent: " + opponent)
+                    print("Ground: " + ground)
+                    print("HomeOrAway: " + homeOrAway)
+                    print("WinOrLoss: " + winOrLoss)
+                    print("FullScorecardAvailable: " + fullScorecardAvailable)
+                    print("Captain: " + captain)
+
+            #Batting
+            if batting[0].get_text(strip=True) != '' and batting[2].get_text(strip=True) != 'dnb':
+
+                battingInningsID = getInningsID(matchID,innings)
+
+                # Consider changing "INSERT OR IGNORE" to "REPLACE"
+                #query = "INSERT OR IGNORE INTO Batting (BattingInningsID, MatchID, Innings, Runs, Position, HowDismissed, Fours, Sixes, TeamWicketsLost, TeamScore, TeamOversFaced) VALUES (?,?,?,?,?,?,null,null,null,null,null)"
+                values = (battingInningsID, matchID, innings, battingRuns, battingPos, battingOut)#, unknown, unknown, unknown, unknown, unknown)
+                battingRows.append(values)
+
+                #battingInningsID += 1
+
+                # If Debug Print Batting/Innings Info
+                if verbose:
+                    print("Batting Figures:")
+                    print("\tRuns: " + str(battingRuns))
+                    print("\tPosition: " + str(battingPos))
+                    print("\tHow out: " + battingOut)
+
+
+            #Bowling
+            if bowling[0].get_text(strip=True) != '':
+
+                bowlingInningsID = getInningsID(matchID,innings)
+
+                # Consider changing "INSERT OR IGNORE" to "REPLACE"
+                #query = "INSERT OR IGNORE INTO Bowling (bowlingInningsID, MatchID, Innings, Overs, Wickets, Runs, Maidens) VALUES (?,?,?,?,?,?,?)"
+                values = (bowlingInningsID, matchID, innings, bowlingOvers, bowlingWickets, bowlingRuns, bowlingMaidens, oversToBalls(bowlingOvers))#, unknown, unknown, unknown, unknown, unknown)
+                bowlingRows.append(values)
+
+                #bowlingInningsID += 1
+
+                # If Debug Print Bowling/Innings Info
+                if verbose:
+                    print("Bowling Figures:")
+                    print("\tOvers: " + bowlingOvers)
+                    print("\tMaidens: " + str(bowlingMaidens))
+                    print("\tWickets: " + str(bowlingWickets))
+                    print("\tRuns: " + str(bowlingRuns))
+
+            #Fielding
+            #if fielding[0].string.encode("ascii", "ignore") != '':
+            #   print "Fielding Figures:"
+
+            # Fetch High Level Batting, Bowling and Fielding stats
+            # Insert into relevant tables.
+
+        prevMatchInfo = {
+            'matchID': matchID,
+            'clubID': clubID,
+            'seasonText': seasonText,
+            'Round': Round,
+            'grade': grade,
+            'opponent': opponent,
+            'ground': ground,
+            'homeOrAway': homeOrAway,
+            'winOrLoss': winOrLoss,
+            'fullScorecardAvailable': fullScorecardAvailable,
+            'captain': captain
+        }
+
+        #print ""
+
+    return seasonText, matchRows, battingRows, bowlingRows, contentHash.hexdigest()
+
+# Parses season page text into rows. Runs in the parse processes, so only takes and returns plain strings and tuples, never soups
+# Returns (parseSeasonPage result, seconds taken), since timings made in the parse processes don't reach our profiler
+def parseSeasonPageText(text, clubID):
+    startTime = time.perf_counter()
+    result = parseSeasonPage(parseSoup(text, seasonPageParseOnly), clubID)
+    return result, time.perf_counter() - startTime
+
+# Config the parse processes need to parse pages the same way we would
+def getParseConfig():
+    return { name: globals()[name] for name in ("debug", "verbose", "parserBackend", "includeMidYearComps", "includeT20Comps", "includeWomensOnlyComps", "includeVeteransComps", "includeJuniorsComps") }
+
+# Runs at the start of each parse process. Processes can start from a fresh import of this module, which wouldn't have any config changed at runtime
+def initParseWorker(config):
+    globals().update(config)
+
+# Works out which of a players seasons need fetching, going by their season watermarks:
+# Seasons never fetched before, seasons whose row on the season list has changed, the latest season, which could have new matches either way,
+# and seasons last written with different include*Comps settings
+# Returns a list of season jobs for runIngestPipeline
+# clubRows - See getClubList
+def getSeasonJobs(playerID, clubRows=None):
+
+    seasonList = getSeasonList(playerID, clubRows)
+
+    playerDB = getPlayerDB(playerID)
+
+    watermarks = getWatermarks(playerDB)
+
+    latestSeason = max( [ seasonText for clubID, seasonID, seasonText, listHash, rowText in seasonList ], default=None )
+
+    filters = getFilterSignature()
+
+    jobs = []
+
+    for clubID, seasonID, seasonText, listHash, rowText in seasonList:
+
+        oldListHash, oldFilters, oldContentHash = watermarks.get( (clubID, seasonID), (None, None, None) )
+
+        # From before migration 5, with the filters in the list hash. Still current if it matches with today's filters
+        if oldFilters is None and oldListHash == getListHash(rowText, filters):
+            oldListHash, oldFilters = listHash, filters
+
+        rowChanged = oldListHash != listHash
+
+        if seasonText != latestSeason and not rowChanged and oldFilters == filters:
+            continue
+
+        # Its row on the season list has changed, so any cached copy of the page is out of date too. Past seasons are cached forever
+        # otherwise, so always ask the site. Served from the cache, the change would be missed and the new list hash saved over it.
+        # Only the filters changing doesn't need the site. The cached page is just parsed again with the new filters
+        if rowChanged:
+            ttl = 0
+        elif seasonText == latestSeason:
+            ttl = currentPageTTL
+        else:
+            ttl = pastSeasonTTL
+
+        jobs.append({
+            'playerID': playerID,
+            'playerDB': playerDB,
+            'clubID': clubID,
+            'seasonID': seasonID,
+            'listHash': listHash,
+            'filters': filters,
+            'oldContentHash': oldContentHash,
+            'url': seasonURL.format(playerID=playerID, clubID=clubID, seasonID=seasonID),
+            'ttl': ttl,
+        })
+
+    if debug:
+        print(str(len(jobs)) + " seasons to fetch for " + str(playerID))
+
+    return jobs
+
+# Writes a batch of parsed seasons, and their watermarks. One transaction per player database, so a season is either fully written or not at all
+# batch - List of (job, parseSeasonPage result)
+def writeSeasons(batch):
+
+    playerDBs = []
+    for job, parsed in batch:
+        if job['playerDB'] not in playerDBs:
+            playerDBs.append(job['playerDB'])
+
+    for playerDB in playerDBs:
+
+        with dbTransaction(playerDB):
+
+            for job, (seasonText, matchRows, battingRows, bowlingRows, contentHash) in batch:
+
+                if job['playerDB'] != playerDB:
+                    continue
+
+                if matchRows:
+                    lastMatchID = matchRows[-1][0]
                 else:
-                    grade = tds[0].get_text(strip=True).replace("'","")
-                    
-                    innings = 1
-    
-                    Round = tds[1].get_text(strip=True)
-    
-                    opponent = tds[3].select("span")[0].get_text(strip=True).replace("'","")
-    
-                    ground = unknown
-    
-                    homeOrAway = unknown
-                    regex = re.findall( r'(red|green)', tds[4].select("img")[0]["src"] )[0]
-                    if regex == "green":
-                        homeOrAway = "Home"
-                    elif regex == "red":
-                        homeOrAway = "Away"
-    
-                    winOrLoss = unknown
-                    
-                    fullScorecardAvailable = unknown
-    
-                    captain = unknown
-    
-                # Fetch Batting Specific Info
-    
-                batting = match.select("td.batting")
-    
-                if (batting[0].get_text(strip=True) != '') and (batting[1].get_text(strip=True) != '') and (batting[2].get_text(strip=True) != 'dnb'):
-                    battingRuns = int(batting[0].get_text(strip=True))
-                    battingPos = int(batting[1].get_text(strip=True))
-                    battingOut = batting[2].get_text(strip=True)
-    
-                # Fetch Bowling Specific Info
-    
-                bowling = match.select("td.bowling")
-    
-                if bowling[0].get_text(strip=True)!= '':
-                    
-                    bowlingOvers = bowling[0].get_text(strip=True)
-    
-                    temp = bowling[1].get_text(strip=True)
+                    lastMatchID = None
 
-                    if temp != '':
-                        bowlingMaidens = int(temp)
-                    else:
-                        bowlingMaidens = 0
-                    
-                    temp = bowling[2].get_text(strip=True)
-                    if temp != '':
-                        bowlingWickets = int(temp)
+                watermarkRow = (job['clubID'], job['seasonID'], seasonText, job['listHash'], job['filters'], len(matchRows), lastMatchID, contentHash)
+
+                # Same matches as last time. Nothing to write, just record the new season list hash
+                if job['oldContentHash'] == contentHash:
+                    if debug:
+                        print(seasonText + " unchanged")
+                else:
+                    writeSeasonRows(playerDB, matchRows, battingRows, bowlingRows)
+
+                dbQuery(playerDB, "INSERT OR REPLACE INTO SeasonWatermarks (ClubID, SeasonID, Season, ListHash, Filters, MatchCount, LastMatchID, ContentHash) VALUES (?,?,?,?,?,?,?,?)", watermarkRow)
+
+# Fetches, parses and writes season jobs as a pipeline. fetchWorkers threads download pages, parseWorkers processes parse them,
+# and a single writer thread writes them to the player databases, up to writeBatchSize seasons at a time. The stages are joined by queues
+# holding at most pipelineQueueSize pages, so a stage that falls behind holds up the stages before it instead of piling up pages in memory
+# players - Any iterable of (playerID, list of that players season jobs), including a generator that works them out as it goes.
+#           Read from its own thread, so it can fetch too. A job with 'playerInfo' (see getPlayerJobs) goes straight to the writer, so the
+#           writer thread is the only one writing to the player databases
+# onPlayerDone - Optional function called with each player ID once every one of their seasons has been written. Not called for players with any failures
+# Returns a dict of playerID -> the first error hit for each player with a season that failed. One player failing doesn't stop the rest.
+# Failed seasons have no watermark, so are fetched again next run. Raises anything that stops the pipeline itself, once it has stopped
+def runIngestPipeline(players, onPlayerDone=None):
+
+    jobQueue = queue.Queue(maxsize=pipelineQueueSize)
+    writeQueue = queue.Queue(maxsize=pipelineQueueSize)
+
+    errors = []
+
+    failed = {}
+
+    parsePool = None
+    if parseWorkers > 0:
+        # spawn, since forking while the other pipeline threads hold locks can deadlock the child. Same as Windows does anyway
+        parsePool = ProcessPoolExecutor(max_workers=parseWorkers, mp_context=multiprocessing.get_context("spawn"), initializer=initParseWorker, initargs=(getParseConfig(),))
+
+    numFetchWorkers = max(fetchWorkers, 1)
+
+    # playerID -> Seasons not written yet. Players with a failed season are dropped, so are never done
+    remaining = {}
+    remainingLock = threading.Lock()
+
+    def playerDone(playerID):
+        if onPlayerDone:
+            onPlayerDone(playerID)
+
+    # Called by the writer for each season, once it's written or has failed. error is None if it was written
+    def finishJob(job, error=None):
+        with remainingLock:
+            if error:
+                failed.setdefault(job['playerID'], error)
+            if job['playerID'] not in remaining:
+                return
+            remaining[job['playerID']] -= 1
+            if error:
+                del remaining[job['playerID']]
+                return
+            done = remaining[job['playerID']] == 0
+        if done:
+            playerDone(job['playerID'])
+
+    # Puts jobs on the job queue, then one None per fetch thread to tell them to stop
+    def feeder():
+        try:
+            for playerID, playerJobs in players:
+                if not playerJobs:
+                    playerDone(playerID)
+                    continue
+                with remainingLock:
+                    remaining[playerID] = len(playerJobs)
+                for job in playerJobs:
+                    if 'playerInfo' in job:
+                        writeQueue.put( (job, None) )
                     else:
-                        bowlingWickets = 0
-    
-                    temp = bowling[3].get_text(strip=True)
-                    if temp != '':    
-                        bowlingRuns = int(temp)
+                        jobQueue.put(job)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            closeAllDatabases()
+            for i in range(numFetchWorkers):
+                jobQueue.put(None)
+
+    # Fetches pages and hands them to the parse processes. Passes on the parse result, or the error if the fetch failed
+    def fetcher():
+        while True:
+            job = jobQueue.get()
+            if job is None:
+                return
+
+            try:
+                text = getPage(job['url'], job['ttl'])
+                if parsePool:
+                    result = parsePool.submit(parseSeasonPageText, text, job['clubID'])
+                else:
+                    result = parseSeasonPageText(text, job['clubID'])
+            except Exception as e:
+                result = e
+
+            writeQueue.put( (job, result) )
+
+            # Courtesy sleep, to reduce load on x. rateLimit already spaces out requests when it's on
+            if not rateLimit:
+                time.sleep(sleepDuration)
+
+    # Waits for each parse to finish, and writes the results in batches. The only thread writing season data
+    def writer():
+        batch = []
+        try:
+            while True:
+                item = writeQueue.get()
+                if item is None:
+                    break
+
+                job, result = item
+                try:
+                    if 'playerInfo' in job:
+                        # Already fetched and parsed by the feeder
+                        writePlayerInfo(job['playerDB'], *job['playerInfo'])
+                        finishJob(job)
                     else:
-                        if debug:
-                            print("I dont think stats from this match should be included.")
-                        bowlingRuns = 0
-    
-                # Fetch Fielding Specific Info
-                # len fielding 5
-                # Catches, CatchesWK, RunoutUnassisted, RunoutAssisted, Stumping
-    
-                fielding = match.select("td.fielding")
-    
-                ### DB Inserts into various tables
-                ##
-                # 
-    
+                        if isinstance(result, Future):
+                            result = result.result()
+                        if isinstance(result, Exception):
+                            raise result
+                        result, seconds = result
+                        record("parseSeasonPage", seconds)
+                        batch.append( (job, result) )
+                except Exception as e:
+                    finishJob(job, e)
+
+                # Write once there's a full batch, or there's nothing else ready to go in this one
+                if len(batch) >= writeBatchSize or writeQueue.empty():
+                    writeSeasons(batch)
+                    for job, result in batch:
+                        finishJob(job)
+                    batch = []
+
+            writeSeasons(batch)
+            for job, result in batch:
+                finishJob(job)
+
+        except Exception as e:
+            errors.append(e)
+            # Keep emptying the queue, so the fetch threads don't block forever
+            while writeQueue.get() is not None:
+                pass
+        finally:
+            closeAllDatabases()
+
+    writerThread = threading.Thread(target=writer, name="Ingest Writer")
+    writerThread.start()
+
+    feederThread = threading.Thread(target=feeder, name="Ingest Feeder")
+    feederThread.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=numFetchWorkers) as executor:
+            for i in range(numFetchWorkers):
+                executor.submit(fetcher)
+        feederThread.join()
+    finally:
+        writeQueue.put(None)
+        writerThread.join()
+        if parsePool:
+            parsePool.shutdown()
+
+    if errors:
+        raise errors[0]
+
+    return failed
+
+# Returns (playerID, jobs) for each of a list of players, fetching each players info first. The first job writes their PlayerInfo and Clubs rows
+# failed - Optional dict. If given, players that fail are added to it as playerID -> error and skipped, instead of stopping the rest.
+#          Once the circuit breaker opens, every player left is added to it with the CircuitOpenError, without trying them
+def getPlayerJobs(playerIDList, failed=None):
+    for i, playerID in enumerate(playerIDList):
+        try:
+            playerRow, clubRows = parsePlayerInfo(playerID)
+            infoJob = {
+                'playerID': playerID,
+                'playerDB': getPlayerDB(playerID),
+                'playerInfo': (playerRow, clubRows),
+            }
+            # Season list from the clubs just fetched, since the writer may not have written them yet
+            playerJobs = [infoJob] + getSeasonJobs(playerID, clubRows)
+        except CircuitOpenError as e:
+            if failed is None:
+                raise
+            for remainingPlayerID in playerIDList[i:]:
+                failed[remainingPlayerID] = e
+            return
+        except Exception as e:
+            if failed is None:
+                raise
+            failed[playerID] = e
+            continue
+        yield playerID, playerJobs
+
+# Prints the players a pass failed for, and why
+# failed - Dict of playerID -> error
+def reportFailedPlayers(failed, passName):
+
+    for playerID, error in failed.items():
+        print("Player " + str(playerID) + " failed in the " + passName + ": " + type(error).__name__ + ": " + str(error))
+
+    if failed:
+        print(str(len(failed)) + " players failed in the " + passName + ": " + ", ".join( [ str(playerID) for playerID in failed ] ))
 
-                # Comp/Grade Inclusion/Exclusion Checks
-                loweredGradeString = grade.lower()
-                excludedComp = False
+# First pass at populating the player database. Fetches as much information as possible without opening individual scorecard views
+def populateDatabaseFirstPass(playerID):
+    failed = runIngestPipeline([ (playerID, getSeasonJobs(playerID)) ])
+    if failed:
+        raise failed[playerID]
 
-                #  T20 Comps
-                if ("t20" in loweredGradeString) and (not includeT20Comps):
-                    excludedComp = True
+# First pass for a whole list of players, including their player info. All players go through the one pipeline,
+# so the next players season list is being fetched while the last players seasons are parsed and written
+# onPlayerDone - See runIngestPipeline
+# Players that fail are reported and skipped, the same as analysePlayers. Returns a dict of their playerID -> error
+def populateDatabasesFirstPass(playerIDList, onPlayerDone=None):
 
-                # Veterans Comps
-                if ("veteran" in loweredGradeString) and (not includeVeteransComps):
-                    excludedComp = True
+    failed = {}
+    failed.update(runIngestPipeline(getPlayerJobs(list(playerIDList), failed), onPlayerDone))
 
-                # Women's Only Comps
-                if ("women" in loweredGradeString) and (not includeWomensOnlyComps):
-                    excludedComp = True
+    reportFailedPlayers(failed, "first pass")
 
-                # Juniors Comps
-                juniorStrings = ["under", "u11","u12","u13","u14","u15","u16","u17","u18","u19","u21"]
-                if (not includeJuniorsComps):
-                    for js in juniorStrings:
-                        if js in loweredGradeString:
-                            excludedComp = True
-                            continue
-
-                if not excludedComp:
-
-                    #Matches
-                    if matchID not in matchList:
-                        # It wont be in DB so insert
-                        # Consider changing "INSERT OR IGNORE" to "INSERT OR REPLACE"
-                        #query = "INSERT OR IGNORE INTO Matches (MatchID, ClubID, Season, Round, Grade, Opponent, Ground, HomeOrAway, WinOrLoss, FullScorecardAvailable, Captain ) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
-                        query = "INSERT OR REPLACE INTO Matches (MatchID, ClubID, Season, Round, Grade, Opponent, Ground, HomeOrAway, WinOrLoss, FullScorecardAvailable, Captain ) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
-                        values = (matchID, clubID, seasonText, Round, grade, opponent, ground, homeOrAway, winOrLoss, fullScorecardAvailable, captain)
-                        dbQuery(playerDB,query,values)
-        
-                        matchList.append(matchID)
-        
-                        # If verbose Print Match Info 
-                        if verbose:
-        
-                            #Match Info
-                            print("MatchID: " + str(matchID))
-                            print("ClubID: " + str(clubID))
-                            print("Season: " + seasonText)
-                            print("Round: " + str(Round))
-                            print("Grade: " + str(grade))
-                            print("Innings: " + str(innings))# Not in Matches Table
-                            print("Opponent: " + opponent)
-                            print("Ground: " + ground)
-                            print("HomeOrAway: " + homeOrAway)
-                            print("WinOrLoss: " + winOrLoss)
-                            print("FullScorecardAvailable: " + fullScorecardAvailable)
-                            print("Captain: " + captain)
-        
-                    #Batting
-                    if batting[0].get_text(strip=True) != '' and batting[2].get_text(strip=True) != 'dnb':
-
-                        battingInningsID = getInningsID(matchID,innings)
-
-                        # Consider changing "INSERT OR IGNORE" to "REPLACE"
-                        #query = "INSERT OR IGNORE INTO Batting (BattingInningsID, MatchID, Innings, Runs, Position, HowDismissed, Fours, Sixes, TeamWicketsLost, TeamScore, TeamOversFaced) VALUES (?,?,?,?,?,?,null,null,null,null,null)"
-                        query = "INSERT OR REPLACE INTO Batting (BattingInningsID, MatchID, Innings, Runs, Position, HowDismissed, Fours, Sixes, TeamWicketsLost, TeamScore, TeamOversFaced) VALUES (?,?,?,?,?,?,null,null,null,null,null)"
-                        values = (battingInningsID, matchID, innings, battingRuns, battingPos, battingOut)#, unknown, unknown, unknown, unknown, unknown)
-                        dbQuery(playerDB,query,values)
-        
-                        #battingInningsID += 1
-        
-                        # If Debug Print Batting/Innings Info
-                        if verbose:
-                            print("Batting Figures:")
-                            print("\tRuns: " + str(battingRuns))
-                            print("\tPosition: " + str(battingPos))
-                            print("\tHow out: " + battingOut)
-        
-        
-                    #Bowling
-                    if bowling[0].get_text(strip=True) != '':
-        
-                        bowlingInningsID = getInningsID(matchID,innings)
-
-                        # Consider changing "INSERT OR IGNORE" to "REPLACE"
-                        #query = "INSERT OR IGNORE INTO Bowling (bowlingInningsID, MatchID, Innings, Overs, Wickets, Runs, Maidens) VALUES (?,?,?,?,?,?,?)"
-                        query = "INSERT OR REPLACE INTO Bowling (bowlingInningsID, MatchID, Innings, Overs, Wickets, Runs, Maidens) VALUES (?,?,?,?,?,?,?)"
-                        values = (bowlingInningsID, matchID, innings, bowlingOvers, bowlingWickets, bowlingRuns, bowlingMaidens)#, unknown, unknown, unknown, unknown, unknown)
-                        dbQuery(playerDB,query,values)
-
-                        #bowlingInningsID += 1
-
-                        # If Debug Print Bowling/Innings Info
-                        if verbose:
-                            print("Bowling Figures:")
-                            print("\tOvers: " + bowlingOvers)
-                            print("\tMaidens: " + str(bowlingMaidens))
-                            print("\tWickets: " + str(bowlingWickets))
-                            print("\tRuns: " + str(bowlingRuns))
-        
-                    #Fielding
-                    #if fielding[0].string.encode("ascii", "ignore") != '':
-                    #   print "Fielding Figures:"
-        
-                    # Fetch High Level Batting, Bowling and Fielding stats
-                    # Insert into relevant tables.
-    
-                prevMatchInfo = {
-                    'matchID': matchID,
-                    'clubID': clubID,
-                    'seasonText': seasonText,
-                    'Round': Round,
-                    'grade': grade,
-                    'opponent': opponent,
-                    'ground': ground,
-                    'homeOrAway': homeOrAway,
-                    'winOrLoss': winOrLoss,
-                    'fullScorecardAvailable': fullScorecardAvailable,
-                    'captain': captain
-                }
-    
-                #print ""
-    
-            # Courtesy sleep, to reduce load on x. 
-            time.sleep(sleepDuration)
+    return failed
+
+# Returns the player ID a link in element points to, or None if it doesn't link to a player
+def getLinkedPlayerID(element):
+
+    link = element.find("a", href=True)
+    if link is None:
+        return None
+
+    found = re.findall(playerLinkPattern, link["href"])
+    if found:
+        return int(found[0])
+    return None
+
+# Text to int, with None for blank or non numeric cells, like "dnb" or "-"
+def toInt(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+# Splits a team total into (score, wickets lost). "8/245" -> (245, 8). All out totals have no wickets on them, "245" -> (245, 10)
+def parseTeamTotal(text):
+
+    wickets, separator, score = text.rpartition("/")
+    if not separator:
+        return toInt(score), 10
+
+    return toInt(score), toInt(wickets)
+
+# Parses a scorecard page. Returns (available, complete, inningsRows, battingRows, fieldingRows), with rows ready for the scorecard tables
+# Batting rows include dnb, so a players nth row for a match lines up with their nth innings from the first pass
+# complete - Both teams have batted, and every innings has its total and batters in. Scorecards are often entered a bit at a time
+def parseScorecard(soup, matchID):
+
+    inningsRows = []
+    battingRows = []
+
+    # (TeamInnings, PlayerID) -> [Catches, RunOuts]
+    fielding = {}
+
+    for teamInnings, table in enumerate(soup.select("#selector"), 1):
+
+        team = table.select("#selector")[0].get_text(strip=True).replace("'","")
+        teamScore, teamWicketsLost = parseTeamTotal(table.select("#selector")[0].get_text(strip=True))
+        teamOversFaced = table.select("#selector")[0].get_text(strip=True)
+
+        inningsRows.append( (matchID, teamInnings, team, teamScore, teamWicketsLost, teamOversFaced) )
+
+        position = 0
+        for row in table.select("tr"):
+
+            tds = row.select("td")
+            if len(tds) < 6:
+                continue
+
+            playerID = getLinkedPlayerID(tds[0])
+            if playerID is None:
+                continue
+
+            position += 1
+
+            howDismissed = tds[1].get_text(" ", strip=True)
+
+            battingRows.append( (matchID, teamInnings, playerID, position, toInt(tds[2].get_text(strip=True)), howDismissed, toInt(tds[4].get_text(strip=True)), toInt(tds[5].get_text(strip=True))) )
+
+            # Fielders are linked in the dismissal, the same as batters. "c Smith b Jones", "run out (Smith)"
+            fielderID = getLinkedPlayerID(tds[1])
+            if fielderID is None:
+                continue
+
+            credit = fielding.setdefault( (teamInnings, fielderID), [0, 0] )
+            if howDismissed.lower().startswith("run out"):
+                credit[1] += 1
+            elif howDismissed.lower().startswith("c"):
+                credit[0] += 1
+
+    fieldingRows = [ (matchID, teamInnings, playerID, catches, runOuts) for (teamInnings, playerID), (catches, runOuts) in fielding.items() ]
+
+    if verbose:
+        print("Scorecard " + str(matchID) + ": " + str(len(inningsRows)) + " innings, " + str(len(battingRows)) + " batters")
+
+    battedInnings = set( [ row[1] for row in battingRows ] )
+    complete = len(inningsRows) >= 2 and all( [ row[3] is not None and row[5] and row[1] in battedInnings for row in inningsRows ] )
+
+    return len(inningsRows) > 0, complete, inningsRows, battingRows, fieldingRows
+
+# Fetches and parses one scorecard. Returns the parseScorecard result, or the error if it couldn't be fetched
+def fetchScorecard(matchID):
+    try:
+        return parseScorecard(getSoup(scorecardURL.format(matchID=matchID), scorecardTTL, scorecardParseOnly), matchID)
+    except Exception as e:
+        return e
+
+# Fetches scorecards into the shared scorecard database, fetchWorkers at a time. Returns a dict of matchID -> error for those that couldn't be fetched
+def fetchScorecards(matchIDs):
+
+    errors = {}
+
+    for i in range(0, len(matchIDs), scorecardBatchSize):
+
+        batch = matchIDs[i:i+scorecardBatchSize]
+
+        with ThreadPoolExecutor(max_workers=max(fetchWorkers, 1)) as executor:
+            results = list(executor.map(fetchScorecard, batch))
+
+        with dbTransaction(scorecardDB):
+            for matchID, result in zip(batch, results):
+
+                # Not stored, so it's tried again next run
+                if isinstance(result, Exception):
+                    errors[matchID] = result
+                    continue
+
+                available, complete, inningsRows, battingRows, fieldingRows = result
+
+                now = time.time()
+                previous = dbQuery(scorecardDB, "SELECT FirstFetched FROM Scorecards WHERE MatchID = ?", (matchID,))
+                if previous and previous[0][0]:
+                    firstFetched = previous[0][0]
+                else:
+                    firstFetched = now
+
+                # Final once it's complete, or once it's been long enough since it was first seen that it isn't going to be filled in
+                final = complete or now - firstFetched >= scorecardFinalAge
+
+                # Replaces any earlier, partly entered, version of the scorecard
+                for table in ["ScorecardInnings", "ScorecardBatting", "ScorecardFielding"]:
+                    dbQuery(scorecardDB, "DELETE FROM " + table + " WHERE MatchID = ?", (matchID,))
+
+                dbQueryMany(scorecardDB, "INSERT OR REPLACE INTO ScorecardInnings (MatchID, TeamInnings, Team, TeamScore, TeamWicketsLost, TeamOversFaced) VALUES (?,?,?,?,?,?)", inningsRows)
+                dbQueryMany(scorecardDB, "INSERT OR REPLACE INTO ScorecardBatting (MatchID, TeamInnings, PlayerID, Position, Runs, HowDismissed, Fours, Sixes) VALUES (?,?,?,?,?,?,?,?)", battingRows)
+                dbQueryMany(scorecardDB, "INSERT OR REPLACE INTO ScorecardFielding (MatchID, TeamInnings, PlayerID, Catches, RunOuts) VALUES (?,?,?,?,?)", fieldingRows)
+                dbQuery(scorecardDB, "INSERT OR REPLACE INTO Scorecards (MatchID, Available, Fetched, FirstFetched, Final) VALUES (?,?,?,?,?)", (matchID, int(available), now, firstFetched, int(final)))
+
+        if debug:
+            print("Fetched " + str(min(i + scorecardBatchSize, len(matchIDs))) + " of " + str(len(matchIDs)) + " scorecards")
+
+    return errors
+
+# Returns the MatchIDs of a players matches that haven't had a final scorecard applied yet
+def getMissingScorecards(playerID):
+    playerDB = getPlayerDB(playerID)
+    return [ row[0] for row in dbQuery(playerDB, "SELECT MatchID FROM Matches WHERE MatchID NOT IN (SELECT MatchID FROM AppliedScorecards WHERE Final = 1)") ]
+
+# Of a list of matches, returns the ones whose scorecard needs fetching. Never fetched, or not final and last fetched more than scorecardTTL ago
+def getStaleScorecards(matchIDs):
+
+    scorecards = { row[0]: row[1:] for row in dbQuery(scorecardDB, "SELECT MatchID, Fetched, Final FROM Scorecards") }
+
+    now = time.time()
+    stale = []
+
+    for matchID in matchIDs:
+        scorecard = scorecards.get(matchID)
+        if scorecard is None or (not scorecard[1] and now - scorecard[0] >= scorecardTTL):
+            stale.append(matchID)
+
+    return stale
+
+# Fills in a players Batting (Fours, Sixes, TeamScore...) and Fielding rows from the shared scorecard database, for every match it has a scorecard for
+# Records the version of each scorecard applied in the players AppliedScorecards, so it's only applied again once there's a newer one, and not at all once it's final
+# Also marks each match FullScorecardAvailable Yes or No. Returns the number of matches still without any scorecard
+def applyScorecards(playerID):
+
+    playerDB = getPlayerDB(playerID)
+
+    missing = 0
+
+    with dbTransaction(playerDB):
+
+        applied = { row[0]: row[1] for row in dbQuery(playerDB, "SELECT MatchID, Fetched FROM AppliedScorecards") }
+
+        for matchID in getMissingScorecards(playerID):
+
+            scorecard = dbQuery(scorecardDB, "SELECT Available, Fetched, Final FROM Scorecards WHERE MatchID = ?", (matchID,))
+
+            # Couldn't be fetched this run
+            if not scorecard:
+                missing += 1
+                continue
+
+            available, fetched, final = scorecard[0]
+
+            # Already has this version
+            if applied.get(matchID) == fetched:
+                continue
+
+            dbQuery(playerDB, "INSERT OR REPLACE INTO AppliedScorecards (MatchID, Fetched, Final) VALUES (?,?,?)", (matchID, fetched, final))
+
+            if not available:
+                dbQuery(playerDB, "UPDATE Matches SET FullScorecardAvailable = ? WHERE MatchID = ?", ("No", matchID))
+                continue
+
+            innings = dbQuery(scorecardDB, "SELECT TeamInnings, Team, TeamScore, TeamWicketsLost, TeamOversFaced FROM ScorecardInnings WHERE MatchID = ? ORDER BY TeamInnings", (matchID,))
+            teams = { row[0]: row[1] for row in innings }
+            totals = { row[0]: row[2:] for row in innings }
+
+            batting = dbQuery(scorecardDB, "SELECT TeamInnings, Fours, Sixes FROM ScorecardBatting WHERE MatchID = ? AND PlayerID = ? ORDER BY TeamInnings", (matchID, playerID))
+
+            for inningsNum, (teamInnings, fours, sixes) in enumerate(batting, 1):
+                teamScore, teamWicketsLost, teamOversFaced = totals[teamInnings]
+                query = "UPDATE Batting SET Fours = ?, Sixes = ?, TeamWicketsLost = ?, TeamScore = ?, TeamOversFaced = ? WHERE BattingInningsID = ?"
+                values = (fours, sixes, teamWicketsLost, teamScore, teamOversFaced, getInningsID(matchID, inningsNum))
+                dbQuery(playerDB, query, values)
+
+            credits = { row[0]: row[1:] for row in dbQuery(scorecardDB, "SELECT TeamInnings, Catches, RunOuts FROM ScorecardFielding WHERE MatchID = ? AND PlayerID = ?", (matchID, playerID)) }
+
+            # They fielded in every innings the other team batted. If they aren't on the batting list at all, only the innings they took a catch or run out in are known
+            playerTeams = set( [ teams[row[0]] for row in batting ] )
+            if playerTeams:
+                fieldingInnings = [ row[0] for row in innings if row[1] not in playerTeams ]
+            else:
+                fieldingInnings = sorted(credits)
+
+            # In case an earlier version of the scorecard had them fielding in more innings
+            dbQuery(playerDB, "DELETE FROM Fielding WHERE MatchID = ?", (matchID,))
+
+            for inningsNum, teamInnings in enumerate(fieldingInnings, 1):
+                catches, runOuts = credits.get(teamInnings, (0, 0))
+                query = "INSERT OR REPLACE INTO Fielding (FieldingInningsID, MatchID, Catches, RunOuts) VALUES (?,?,?,?)"
+                values = (matchID * 10 + inningsNum, matchID, catches, runOuts)
+                dbQuery(playerDB, query, values)
+
+            dbQuery(playerDB, "UPDATE Matches SET FullScorecardAvailable = ? WHERE MatchID = ?", ("Yes", matchID))
+
+    return missing
 
 # Second pass at populating the player database. Goes through scorecards (if available) for all games in matchList
 def populateDatabaseSecondPass(playerID):
-    print("TODO")
+    failed = populateDatabasesSecondPass([playerID])
+    if failed:
+        raise failed[playerID]
+
+# Second pass for a whole list of players. Scorecards are fetched into the shared scorecard database, each match only once
+# however many of the players played in it. Final scorecards are never fetched again, others once they are scorecardTTL old.
+# Then each players rows are filled in from there
+# onPlayerDone - Optional function called with each player ID once all of their scorecards have been applied
+# Players with a scorecard that couldn't be fetched are reported, and the rest carry on. Returns a dict of their playerID -> error
+def populateDatabasesSecondPass(playerIDList, onPlayerDone=None):
+
+    createScorecardDatabase()
+
+    matchIDs = []
+    playerMatchIDs = {}
+    for playerID in playerIDList:
+        playerMatchIDs[playerID] = getMissingScorecards(playerID)
+        matchIDs.extend(playerMatchIDs[playerID])
+
+    # Each match once, in the order first seen
+    toFetch = getStaleScorecards(list(dict.fromkeys(matchIDs)))
+
+    if debug:
+        print(str(len(toFetch)) + " scorecards to fetch, for " + str(len(set(matchIDs))) + " matches")
+
+    errors = fetchScorecards(toFetch)
+
+    failed = {}
+
+    for playerID in playerIDList:
+        if applyScorecards(playerID) == 0:
+            if onPlayerDone:
+                onPlayerDone(playerID)
+            continue
+
+        playerErrors = [ errors[matchID] for matchID in playerMatchIDs[playerID] if matchID in errors ]
+        if playerErrors:
+            failed[playerID] = playerErrors[0]
+        else:
+            failed[playerID] = FetchError("Scorecards missing for player " + str(playerID))
+
+    reportFailedPlayers(failed, "second pass")
+
+    return failed
 
 # Third pass at populating the player database. Specifically concerning the TeamMates and TeamMatesMatches tables.
 def populateDatabaseThirdPass(playerID):
@@ -0,0 +1,83 @@
+#!python3
+###############################################################################
+# fixtures.py - Record/replay store of fetched pages for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import os, json, time, random, hashlib
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# None to fetch from the site as normal
+# "record" - Fetch as normal, and save every page to fixtureDirectory
+# "replay" - Never touch the network. Every page comes from fixtureDirectory, and any page not in there is a FetchError
+fixtureMode = None
+
+fixtureDirectory = "Fixtures"
+
+# Seconds each replayed page takes, to stand in for the site's response time. Plus up to replayJitter seconds at random
+replayLatency = 0
+
+replayJitter = 0
+
+###############################################################################
+# Functions
+# Each page is saved as "<fixtureDirectory>/<hash of url>.json", holding the url and the page text.
+# Unlike the page cache, fixtures never expire and are never evicted, so a recorded run can be replayed any number of times.
+
+# Puts a url in a standard form, so the same page always gets the same key. Lower case scheme and host, query parameters sorted
+def normaliseURL(url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit( (parts.scheme.lower(), parts.netloc.lower(), parts.path, query, "") )
+
+def getFixtureKey(url):
+    return hashlib.sha256(normaliseURL(url).encode("utf-8")).hexdigest()
+
+def getFixturePath(url):
+    return os.path.join(fixtureDirectory, getFixtureKey(url) + ".json")
+
+# Saves a fetched page. Written to a temp file first, so a fixture is never half written
+def recordPage(url, text):
+
+    path = getFixturePath(url)
+    os.makedirs(fixtureDirectory, exist_ok=True)
+
+    fixture = {
+        "url": normaliseURL(url),
+        "text": text,
+        "recorded": time.time(),
+    }
+
+    tempPath = path + "." + str(os.getpid()) + ".tmp"
+    with open(tempPath, "w", encoding="utf-8") as f:
+        json.dump(fixture, f)
+    os.replace(tempPath, path)
+
+    if debug:
+        print("Recorded %s" % url)
+
+# Returns the recorded text for a url, after the simulated latency. None if the url was never recorded
+def replayPage(url):
+
+    try:
+        with open(getFixturePath(url), encoding="utf-8") as f:
+            text = json.load(f)["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    delay = replayLatency + random.uniform(0, replayJitter)
+    if delay > 0:
+        time.sleep(delay)
+
+    if debug:
+        print("Replayed %s" % url)
+
+    return text
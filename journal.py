@@ -0,0 +1,147 @@
+#!python3
+###############################################################################
+# journal.py - Checkpoint journal of multi player runs for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import os, json, hashlib, threading
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Record each player and stage as it finishes, so a run that dies part way can pick up where it left off
+useJournal = True
+
+# Each run has its own journal in here, named after the run, so runs with different players or settings can go at the same time
+journalDirectory = "Player Databases/Journals"
+
+###############################################################################
+# Functions
+# A run is keyed by a hash of its player list and settings, and journals to "<journalDirectory>/<key>.jsonl". One JSON object per line.
+# The first line names the run. Each line after that is a (player, stage) that has finished. A run that finishes deletes its journal,
+# so a journal on disk is always an unfinished run, and a new run with the same key carries on from it.
+# Lines are flushed and synced to disk as they are written, so a crash loses at most the line being written.
+
+journalLock = threading.Lock()
+
+journal = None
+
+journalPath = None
+
+# (playerID, stage) pairs done in the current run
+completed = set()
+
+def getRunKey(playerIDList, settings):
+    return hashlib.sha256(json.dumps([list(playerIDList), settings], sort_keys=True).encode("utf-8")).hexdigest()
+
+def getJournalPath(runKey):
+    return os.path.join(journalDirectory, runKey + ".jsonl")
+
+# Reads a journal. Returns the completed (player, stage) pairs, or None if there isn't one.
+# A journal without its header, e.g. left empty by a crash straight after it was created, is treated as not there, and started again
+def readJournal(path):
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    done = set()
+    hasHeader = False
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Half written last line, from a crash
+            continue
+
+        if "run" in entry:
+            hasHeader = True
+        elif "player" in entry:
+            done.add( (entry["player"], entry["stage"]) )
+
+    if not hasHeader:
+        return None
+
+    return done
+
+def endsWithNewline(path):
+    if os.path.getsize(path) == 0:
+        return True
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+def writeLine(entry):
+    journal.write(json.dumps(entry) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+# Starts journaling a run. Carries on from its journal if the same run was started before and didn't finish, unless restart is set
+# settings - Anything else that makes this run different from another with the same players, e.g. the stages being run
+def startRun(playerIDList, settings, restart=False):
+    global journal, journalPath, completed
+
+    if not useJournal:
+        return
+
+    runKey = getRunKey(playerIDList, settings)
+    path = getJournalPath(runKey)
+    previous = readJournal(path)
+
+    os.makedirs(journalDirectory, exist_ok=True)
+
+    with journalLock:
+        journalPath = path
+        if previous is not None and not restart:
+            completed = previous
+            journal = open(path, "a", encoding="utf-8")
+            # End a half written last line, so the next entry starts on a line of its own
+            if not endsWithNewline(path):
+                journal.write("\n")
+            print("Resuming run. " + str(len(completed)) + " player stages already done")
+        else:
+            completed = set()
+            journal = open(path, "w", encoding="utf-8")
+            writeLine({"run": runKey, "players": len(playerIDList), "settings": settings})
+
+# Whether a player has finished a stage in this run
+def isDone(playerID, stage):
+    return (playerID, stage) in completed
+
+# Returns the players in a list that haven't finished a stage yet, in the same order
+def getRemaining(playerIDList, stage):
+    return [ playerID for playerID in playerIDList if not isDone(playerID, stage) ]
+
+# Records that a player has finished a stage. Safe to call from any thread
+def markDone(playerID, stage):
+
+    if journal is None:
+        return
+
+    with journalLock:
+        if (playerID, stage) in completed:
+            return
+        completed.add( (playerID, stage) )
+        writeLine({"player": playerID, "stage": stage})
+
+    if debug:
+        print("Player " + str(playerID) + " finished " + stage)
+
+# Marks the run as finished by deleting its journal, so the next run with the same key starts from the beginning
+def finishRun():
+    global journal
+
+    if journal is None:
+        return
+
+    with journalLock:
+        journal.close()
+        journal = None
+        os.remove(journalPath)
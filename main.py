@@ -6,26 +6,46 @@
 ###############################################################################
 # Imports
 
-import os
+import os, sys, time, argparse, traceback, multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from database import *
 from fetch import *
 from analysis import *
+from telemetry import writeMetrics, getSummary
+from profiler import timed, setPlayer, setEnabled, takeTimings, mergeTimings, writeReport, reportFile
+from manifest import getInputHash, isUpToDate, getEntry, loadManifest, saveManifest, useManifest
+from daemon import runDaemon
+from journal import startRun, getRemaining, markDone, finishRun
+
+# Modules whose config the command line sets. Imported by name too, since main has its own fetch setting
+import fetch as fetchModule
 
 ###############################################################################
 # User Input
 
 debug = False
 
-wipe = False # TODO Determine whether to wipe based on schema change or not
-fetch = True # Deprecated?
+wipe = False # Schema changes are applied in place by migrateDatabase. Only needed to rebuild a player from scratch
+fetch = True # Set False to only regenerate pages from the data already fetched. Safe to run while another run is fetching
 analysis = True
+index = True # Rebuild the index page of every players stats page
+force = False # Rewrite every players page, even the ones the build manifest says are up to date
+daemon = False # Keep running, refreshing players on a schedule instead of all at once. See daemon.py
+profile = None # File to write the run profile to, timings for each stage and stats function. None to not write one
+migrate = False # One shot copy of the per player databases into the warehouse. See useWarehouse in database.py
+restart = False # Start from the first player, even if the last run with the same players didn't finish. See journal.py
 #rebuildIndex = True # Deprecated
 
+# Processes writing player pages and graphs at once. 1 to do them one at a time in this process
+analysisWorkers = os.cpu_count() or 1
+
 # Get Player ID
 #playerID = int(input("Enter PlayerID: "))
 
-# Comma Separated Player List
+# Comma Separated Player List. Used when no players are given on the command line
 playerIDList = [
 
 ]
@@ -33,119 +53,403 @@ playerIDList = [
 ###############################################################################
 # Main
 
-startTime = datetime.now()
-print("Start - " + str(startTime))
+# Writes a players stats page and graphs. Returns the paths written
+def analysePlayer(playerID):
 
-print("")
+    playerDB = getPlayerDB(playerID)
 
-createDirectory("Player Databases")
+    try:
+        newGamesPlayed = stats_PlayerInfo(playerID)
 
-createDirectory("Player Stats")
+        # Read everything from one snapshot, in case another run is writing to this database at the same time
+        with dbTransaction(playerDB, "DEFERRED"):
 
-numPlayers = str(len(playerIDList))
+            # Open/Clean Player Stats File
+            playerName = getPlayerName(playerID)
+            pagePath = "Player Stats/" + str(playerID) + "-" + playerName.replace(' ', '-').lower() + ".html"
+            playerStats = open(pagePath, "w")
+            setGlobals(playerStats)
+            writeHTMLTemplatePart1()
+            playerStats.close()
 
-print(numPlayers + " players in playerIDList")
+            # Re Open in append mode, and then set as global
+            playerStats = open(pagePath, "a")
+            setGlobals(playerStats) 
 
-playerLoopCounter = 0
+            idAndNameString = str(playerID) + " - " + playerName
+            writeHTMLTemplatePart2(idAndNameString, newGamesPlayed)
 
-for playerID in playerIDList:
+            ### Batting
 
-    playerDB = "Player Databases/" + str(playerID) + ".db"
+            ## Normal Stats
+            stats_Recent(playerID, "Batting", 5)
+            stats_Overall(playerID, "Batting")
+            stats_Batting_Graphs(playerID)
 
-    createDatabase(playerID, wipe)
+            stats_Club(playerID,"Batting")
+            #stats_Opponent(playerID,"Batting")
+            stats_Grade(playerID,"Batting")
+            #stats_HomeOrAway(playerID,"Batting")
 
-    oldGamesPlayed = stats_PlayerInfo(playerID)
+            ## Batting Only Functions
+            stats_Batting_DismissalBreakdown(playerID)
+            stats_Batting_Position(playerID)
 
-    fetchPlayerInfo(playerID)
+            ## Move specific functions to bottom of page
+            stats_Season(playerID, "Batting")
+            stats_JuniorSenior(playerID, "Batting")
 
-    newGamesPlayed = stats_PlayerInfo(playerID)
+            ## "Fun" stuff at the very bottom
+            stats_Batting_Bingo(playerID)
+            stats_Batting_NohitBrohitLine(playerID)
+
+            writeHTMLTemplatePart3()
+
+            ### Bowling
+
+            ## Normal Stats
+            stats_Recent(playerID, "Bowling", 5)
+            stats_Overall(playerID, "Bowling")
+            stats_Bowling_Graphs(playerID)
+
+            stats_Club(playerID,"Bowling")
+            #stats_Opponent(playerID,"Bowling")
+            stats_Grade(playerID,"Bowling")
+            #stats_HomeOrAway(playerID,"Bowling")
+
+            ## Bowling Only
+            stats_Bowling_Workload(playerID)
+
+            ## Move specific functions to bottom of page
+            stats_Season(playerID, "Bowling")
+            stats_JuniorSenior(playerID, "Bowling")
+
+            writeHTMLTemplatePart4()
+            playerStats.close()
+
+        # Every file written for the player. The graphs are only there if there was something to plot
+        return [pagePath, "Player Stats/images/" + str(playerID) + "-Batting.png", "Player Stats/images/" + str(playerID) + "-Bowling.png"]
+
+    finally:
+        # Done with this player, close their database connection
+        closeDatabase(playerDB)
+
+# analysePlayer, for the worker processes. Skipped if the players manifest entry shows nothing has changed since their page was last written
+# Returns (error, new manifest entry, timings). error is None, or the error as text, so one player failing doesn't stop the rest.
+# entry is None if skipped. timings are the profiler timings made in this process, to be merged into the main process
+def analysePlayerWorker(playerID, entry=None):
+
+    setPlayer(playerID)
+
+    try:
+        inputHash = getInputHash(playerID)
+        if isUpToDate(entry, inputHash):
+            return None, None, takeTimings()
+
+        outputs = analysePlayer(playerID)
+
+        # inputHash is from before the page was written, so a write made while it was being written gets it rebuilt next time
+        return None, getEntry(inputHash, outputs), takeTimings()
+    except Exception:
+        return traceback.format_exc(), None, takeTimings()
+    finally:
+        setPlayer(None)
+        closeDatabase(getPlayerDB(playerID))
+
+def newAnalysisPool(workers):
+    # spawn, so workers don't inherit our open database connections. That also means they start with profiling off
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=setEnabled, initargs=(profile is not None,))
+
+# Runs one player on their own process, to find out whether they are the one killing it
+def analysePlayerAlone(playerID, entry):
+    with newAnalysisPool(1) as executor:
+        try:
+            return executor.submit(analysePlayerWorker, playerID, entry).result()
+        except BrokenProcessPool as e:
+            return "Analysis process died while writing this player: " + str(e), None, ({}, {})
+
+# Runs analysePlayerWorker for each player over analysisWorkers processes, and yields the results in playerIDList order
+# A process dying (out of memory, a crash in matplotlib) breaks the whole pool, and fails every player it was running. The first of them is
+# run again on their own, to find out if they were the cause, and the pool is started again for the rest. Results already in are kept
+def analysePlayersInPool(playerIDList, entries):
+
+    executor = None
+    futures = {}
+
+    try:
+        for i in range(len(playerIDList)):
+
+            if executor is None:
+                executor = newAnalysisPool(analysisWorkers)
+                for j in range(i, len(playerIDList)):
+                    future = futures.get(j)
+                    if future is None or future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+                        futures[j] = executor.submit(analysePlayerWorker, playerIDList[j], entries[j])
+
+            try:
+                result = futures.pop(i).result()
+            except BrokenProcessPool:
+                executor.shutdown()
+                executor = None
+                result = analysePlayerAlone(playerIDList[i], entries[i])
+
+            yield result
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+# Runs analysePlayer for every player, spread over analysisWorkers processes. Players share nothing, so each gets a process to itself
+# Players that haven't changed since their page was last written are skipped, unless force is set. See manifest.py
+# Progress is reported in playerIDList order. Returns the IDs of the players that failed
+# onPlayerDone - Optional function called with each player ID whose page is written, or was already up to date
+def analysePlayers(playerIDList, force=False, onPlayerDone=None):
+
+    numPlayers = str(len(playerIDList))
+    failedPlayers = []
+    skippedPlayers = 0
+
+    manifest = loadManifest()
+
+    if force or not useManifest:
+        entries = [None] * len(playerIDList)
+    else:
+        entries = [ manifest.get(str(playerID)) for playerID in playerIDList ]
+
+    if analysisWorkers <= 1 or len(playerIDList) <= 1:
+        results = map(analysePlayerWorker, playerIDList, entries)
+    else:
+        results = analysePlayersInPool(playerIDList, entries)
+
+    try:
+        for playerLoopCounter, (playerID, (error, entry, timings)) in enumerate(zip(playerIDList, results), 1):
+            mergeTimings(timings)
+            if error:
+                failedPlayers.append(playerID)
+                manifest.pop(str(playerID), None)
+                print("Player " + str(playerID) + " failed:")
+                print(error)
+            elif entry:
+                manifest[str(playerID)] = entry
+            else:
+                skippedPlayers += 1
+            if not error and onPlayerDone:
+                onPlayerDone(playerID)
+            print(str(playerLoopCounter) + " players completed out of " + numPlayers)
+    finally:
+        if hasattr(results, "close"):
+            results.close()
+        saveManifest(manifest)
+
+    if skippedPlayers:
+        print(str(skippedPlayers) + " players unchanged since their page was last written")
+
+    if failedPlayers:
+        print(str(len(failedPlayers)) + " players failed: " + ", ".join( [ str(playerID) for playerID in failedPlayers ] ))
+
+    return failedPlayers
+
+# Reads player IDs from a file. Separated by commas, spaces or new lines. Anything after a # is a comment
+def readPlayerIDs(f):
+
+    playerIDs = []
+
+    for line in f:
+        line = line.split("#", 1)[0]
+        for playerID in line.replace(",", " ").split():
+            playerIDs.append(int(playerID))
+
+    return playerIDs
+
+# Command line flag -> fetch.py setting, for each comp type
+compFlags = {
+    "midyear": "includeMidYearComps",
+    "t20": "includeT20Comps",
+    "womens": "includeWomensOnlyComps",
+    "veterans": "includeVeteransComps",
+    "juniors": "includeJuniorsComps",
+}
+
+# Reads the command line, and sets the config above (and fetch.py's) from it. Anything not given keeps its value from the config
+def parseArgs(argv=None):
+    global debug, wipe, fetch, analysis, index, migrate, restart, force, daemon, profile, analysisWorkers, playerIDList
+
+    parser = argparse.ArgumentParser(description="Scrapes local cricket stats, and writes a stats page for each player")
+
+    parser.add_argument("playerIDs", nargs="*", type=int, help="Player IDs. Defaults to playerIDList in main.py")
+    parser.add_argument("-f", "--players-file", help="File of player IDs, separated by commas, spaces or new lines. - for stdin")
+
+    parser.add_argument("-s", "--stage", action="append", choices=["fetch", "analyse", "index"],
+        help="Only run these stages. Can be given more than once. Defaults to the fetch, analysis and index settings in main.py")
+
+    parser.add_argument("--wipe", action="store_true", default=wipe, help="Rebuild each player from scratch")
+    parser.add_argument("--migrate", action="store_true", default=migrate, help="Copy the per player databases into the warehouse first")
 
-    difference = newGamesPlayed - oldGamesPlayed
+    parser.add_argument("--fetch-workers", type=int, default=fetchModule.fetchWorkers, help="Pages fetched at once")
+    parser.add_argument("--parse-workers", type=int, default=fetchModule.parseWorkers, help="Processes parsing season pages. 0 to parse in the fetch threads")
+    parser.add_argument("--analysis-workers", type=int, default=analysisWorkers, help="Processes writing player pages")
 
-    # fetch flag deprecated. Replaced with difference check.
-    #if fetch:
+    parser.add_argument("--rate-limit", type=float, default=fetchModule.rateLimit, help="Max requests per second to the site. 0 for no limit")
+    parser.add_argument("--rate-burst", type=int, default=fetchModule.rateBurst, help="Requests that can go out back to back before the rate limit applies")
 
-    # difference check disabled to try a new behaviour. 
-    # Default behaviour will now be: if difference is less than 10 (including 0 now) fetch the 2 most recent seaons.
-    # Combined with changing the sql from "INSERT OR IGNORE" to "REPLACE"
-    #if difference:
-    if True:
+    parser.add_argument("--include", action="append", default=[], choices=sorted(compFlags), help="Include a type of comp. Can be given more than once")
 
-        populateDatabaseFirstPass(playerID, difference)
+    parser.add_argument("--daemon", action="store_true", default=daemon, help="Keep running, refreshing each player as often as their activity calls for")
 
-        #populateDatabaseSecondPass(playerID)
+    parser.add_argument("--force", action="store_true", help="Rewrite every players page, even if nothing has changed since it was last written")
 
-        #populateDatabaseThirdPass(playerID)
+    parser.add_argument("--restart", action="store_true", default=restart, help="Ignore the journal of an unfinished run, and start again from the first player")
 
-    if analysis:
+    parser.add_argument("--profile", nargs="?", const=reportFile, default=profile, metavar="FILE",
+        help="Time each stage, and each stats function for each player, and write a JSON report to FILE (default " + reportFile + ")")
+
+    parser.add_argument("--debug", action="store_true", default=debug)
+
+    args = parser.parse_args(argv)
+
+    if args.players_file == "-":
+        playerIDList = readPlayerIDs(sys.stdin)
+    elif args.players_file:
+        with open(args.players_file) as f:
+            playerIDList = readPlayerIDs(f)
+    else:
+        playerIDList = list(playerIDList)
+
+    playerIDList.extend(args.playerIDs)
+
+    if args.stage:
+        fetch = "fetch" in args.stage
+        analysis = "analyse" in args.stage
+        index = "index" in args.stage
+
+    debug = args.debug
+    wipe = args.wipe
+    migrate = args.migrate
+    force = force or args.force
+    restart = args.restart
+    daemon = args.daemon
+    profile = args.profile
+    setEnabled(profile is not None)
+    analysisWorkers = args.analysis_workers
+
+    fetchModule.fetchWorkers = args.fetch_workers
+    fetchModule.parseWorkers = args.parse_workers
+    fetchModule.rateLimit = args.rate_limit
+    fetchModule.rateBurst = args.rate_burst
+    if args.debug:
+        fetchModule.debug = True
 
-        # Open/Clean Player Stats File
-        playerName = getPlayerName(playerID)
-        playerStats = open("Player Stats/" + str(playerID) + "-" + playerName.replace(' ', '-').lower() + ".html", "w")
-        setGlobals(playerStats)
-        writeHTMLTemplatePart1()
-        playerStats.close()
+    for comp in args.include:
+        setattr(fetchModule, compFlags[comp], True)
 
-        # Re Open in append mode, and then set as global
-        playerStats = open("Player Stats/" + str(playerID) + "-" + playerName.replace(' ', '-').lower() + ".html", "a")
-        setGlobals(playerStats) 
+    return args
 
-        idAndNameString = str(playerID) + " - " + playerName
-        writeHTMLTemplatePart2(idAndNameString, newGamesPlayed)
+# Fetches and rebuilds one player, for the daemon
+def refreshPlayer(playerID):
 
-        ### Batting
+    createDatabase(playerID, False)
+    closeDatabase(getPlayerDB(playerID))
 
-        ## Normal Stats
-        stats_Recent(playerID, "Batting", 5)
-        stats_Overall(playerID, "Batting")
-        stats_Batting_Graphs(playerID)
+    # Pages shared from the last refresh could be hours old by now
+    clearCoalesced()
 
-        stats_Club(playerID,"Batting")
-        #stats_Opponent(playerID,"Batting")
-        stats_Grade(playerID,"Batting")
-        #stats_HomeOrAway(playerID,"Batting")
+    # Failures are raised, so the daemon can retry the player sooner, or back off if the site is down
+    if fetch:
+        failed = populateDatabasesFirstPass([playerID]) or populateDatabasesSecondPass([playerID])
+        if failed:
+            raise failed[playerID]
 
-        ## Batting Only Functions
-        stats_Batting_DismissalBreakdown(playerID)
-        stats_Batting_Position(playerID)
+    if analysis and analysePlayers([playerID], force):
+        raise Exception("Writing the stats page failed")
 
-        ## Move specific functions to bottom of page
-        stats_Season(playerID, "Batting")
-        stats_JuniorSenior(playerID, "Batting")
+# Run between batches of daemon refreshes
+def daemonIdle():
+    if index:
+        rebuildIndex()
+    writeMetrics()
 
-        ## "Fun" stuff at the very bottom
-        stats_Batting_Bingo(playerID)
-        stats_Batting_NohitBrohitLine(playerID)
+def main(argv=None):
 
-        writeHTMLTemplatePart3()
+    parseArgs(argv)
 
-        ### Bowling
+    if daemon:
+        createDirectory("Player Databases")
+        createDirectory("Player Stats")
 
-        ## Normal Stats
-        stats_Recent(playerID, "Bowling", 5)
-        stats_Overall(playerID, "Bowling")
-        stats_Bowling_Graphs(playerID)
+        # One player at a time is too few pages to be worth starting parse processes for
+        fetchModule.parseWorkers = 0
 
-        stats_Club(playerID,"Bowling")
-        #stats_Opponent(playerID,"Bowling")
-        stats_Grade(playerID,"Bowling")
-        #stats_HomeOrAway(playerID,"Bowling")
+        runDaemon(playerIDList, refreshPlayer, daemonIdle)
+        return
 
-        ## Bowling Only
-        stats_Bowling_Workload(playerID)
+    startTime = datetime.now()
+    print("Start - " + str(startTime))
 
-        ## Move specific functions to bottom of page
-        stats_Season(playerID, "Bowling")
-        stats_JuniorSenior(playerID, "Bowling")
+    print("")
 
-        writeHTMLTemplatePart4()
-        playerStats.close()
+    createDirectory("Player Databases")
 
-    playerLoopCounter += 1
-    print(str(playerLoopCounter) + " players completed out of " + numPlayers)
+    createDirectory("Player Stats")
 
-rebuildIndex()
+    if migrate:
+        migrateToWarehouse()
 
-endTime = datetime.now()
-print("End - " + str(endTime))
-print("Took: " + str( endTime - startTime ))
+    numPlayers = str(len(playerIDList))
+
+    print(numPlayers + " players in playerIDList")
+
+    # Each stage skips the players the journal says it has already done, if this is a rerun of a run that didn't finish
+    startRun(playerIDList, {"fetch": fetch, "analysis": analysis, "wipe": wipe, "force": force}, restart)
+
+    # Players that failed any stage. Their journal is kept while there are any, so the next run only redoes what they didn't finish
+    failedPlayers = set()
+
+    if fetch or analysis:
+        with timed("run.createDatabases"):
+            for playerID in getRemaining(playerIDList, "create"):
+                createDatabase(playerID, wipe)
+                closeDatabase(getPlayerDB(playerID))
+                markDone(playerID, "create")
+
+    # Every players info and seasons go through one fetch -> parse -> write pipeline, so the network, CPU and disk are all kept busy
+    # Only seasons that may have changed since the last run are fetched. See the season watermarks in getSeasonJobs
+    # Players that fail are reported and left for the next run, so every player still gets their page written from the data they have
+    if fetch:
+
+        with timed("run.firstPass"):
+            failedPlayers.update(populateDatabasesFirstPass(getRemaining(playerIDList, "fetch"), lambda playerID: markDone(playerID, "fetch")))
+
+        # Fours, Sixes, team totals and Fielding, from each match's scorecard
+        with timed("run.secondPass"):
+            failedPlayers.update(populateDatabasesSecondPass(getRemaining(playerIDList, "scorecards"), lambda playerID: markDone(playerID, "scorecards")))
+
+        #populateDatabaseThirdPass(playerID)
+
+    if analysis:
+        with timed("run.analysis"):
+            failedPlayers.update(analysePlayers(getRemaining(playerIDList, "analysis"), force, lambda playerID: markDone(playerID, "analysis")))
+
+    # Always the whole index, so it includes the pages written before a resume too
+    if index:
+        with timed("run.index"):
+            rebuildIndex()
+
+    if failedPlayers:
+        print("Keeping the run journal for the " + str(len(failedPlayers)) + " players that failed. Run again to retry just them, or with --restart to start over")
+    else:
+        finishRun()
+
+    endTime = datetime.now()
+    print("End - " + str(endTime))
+    print("Took: " + str( endTime - startTime ))
+
+# Guarded, since the parse processes import this module too
+if __name__ == "__main__":
+    startTime = time.perf_counter()
+    try:
+        main()
+    finally:
+        # Even if the run stopped early, e.g. on the circuit breaker. Not if nothing was fetched, e.g. for --help
+        if getSummary()["pages"]:
+            writeMetrics()
+        if profile:
+            writeReport(profile, time.perf_counter() - startTime)
@@ -0,0 +1,109 @@
+#!python3
+###############################################################################
+# manifest.py - Build manifest of player stats pages for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import os, json, hashlib
+
+from database import dbQuery, getPlayerDB
+from cache import writeFileAtomic
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Skip players whose data and page code haven't changed since their page was last written
+useManifest = True
+
+# Kept out of "Player Stats", since rebuildIndex lists everything in there
+manifestFile = "Player Databases/build-manifest.json"
+
+# Tables a players page is written from
+inputTables = ["PlayerInfo", "Clubs", "Matches", "Batting", "Bowling", "Fielding"]
+
+# Source files that decide what a page looks like. Changing any of them rebuilds every page
+# database.py for ballsToOvers. fetch.py is left out, since analysis only uses it to read the Clubs table
+codeFiles = ["analysis.py", "snapshot.py", "main.py", "database.py"]
+
+###############################################################################
+# Functions
+# The manifest maps each player ID to the hash of their inputs when their page was last written, and the hash of each file written.
+# A player is up to date if their inputs hash the same, and every output is still there, unchanged.
+
+codeHash = None
+
+# Hash of the page code. Worked out once per process
+def getCodeHash():
+    global codeHash
+
+    if codeHash is None:
+        h = hashlib.sha256()
+        for name in codeFiles:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+            try:
+                h.update(hashFile(path).encode("utf-8"))
+            except OSError:
+                pass
+        codeHash = h.hexdigest()
+
+    return codeHash
+
+def hashFile(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# Hash of everything a players page is written from. Their rows in every input table, and the page code
+def getInputHash(playerID):
+
+    playerDB = getPlayerDB(playerID)
+
+    h = hashlib.sha256(getCodeHash().encode("utf-8"))
+
+    for table in inputTables:
+        h.update(("\n" + table + "\n").encode("utf-8"))
+        for row in dbQuery(playerDB, "SELECT * FROM " + table + " ORDER BY 1"):
+            h.update((repr(row) + "\n").encode("utf-8"))
+
+    return h.hexdigest()
+
+# Returns the manifest. Empty if there isn't one yet, or it can't be read
+def loadManifest():
+    try:
+        with open(manifestFile, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Saves the manifest. Written to a temp file first, so it is never half written. The temp file is named for this process and thread,
+# so runs saving at the same time don't write over each others temp file
+def saveManifest(manifest):
+    writeFileAtomic(manifestFile, json.dumps(manifest, indent=1, sort_keys=True))
+
+# Whether a players manifest entry still matches. entry is their manifest entry, or None
+def isUpToDate(entry, inputHash):
+
+    if not entry or entry.get("inputs") != inputHash:
+        return False
+
+    for path, outputHash in entry.get("outputs", {}).items():
+        try:
+            if hashFile(path) != outputHash:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+# Returns a new manifest entry for a page that has just been written
+def getEntry(inputHash, outputs):
+    return {
+        "inputs": inputHash,
+        "outputs": { path: hashFile(path) for path in outputs if os.path.exists(path) },
+    }
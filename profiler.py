@@ -0,0 +1,193 @@
+#!python3
+###############################################################################
+# profiler.py - Per stage timings and run report for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import json, time, random, threading, functools
+
+from contextlib import contextmanager
+
+from telemetry import percentile
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Timings are only taken while this is on. main turns it on for --profile. Off, timed blocks and profiled functions just run, with no locking
+enabled = False
+
+# Written by writeReport at the end of a run, when asked for
+reportFile = "run-profile.json"
+
+# Most single timings kept for each stage, for its percentiles. Past that a random sample is kept, so hot stages like dbQuery don't eat memory
+maxSamples = 100000
+
+# Number of slowest players listed for each stage
+numSlowest = 5
+
+###############################################################################
+# Functions
+# Every timing goes to its stage's totals. Timings made while a player is set with setPlayer also go to that player,
+# so the report can compare players against each other. Stage timings nest, e.g. dbQuery time is also inside the stats_ function that ran it.
+
+statsLock = threading.Lock()
+
+# stage -> [count, total seconds, max seconds, samples]
+stageStats = {}
+
+# playerID -> {stage: seconds}
+playerTimings = {}
+
+currentPlayer = threading.local()
+
+# Turns timing on or off. Also the initializer for worker processes, which start with it off
+def setEnabled(on):
+    global enabled
+    enabled = on
+
+def record(stage, seconds):
+
+    if not enabled:
+        return
+
+    playerID = getattr(currentPlayer, "playerID", None)
+
+    with statsLock:
+        stats = stageStats.get(stage)
+        if stats is None:
+            stats = stageStats[stage] = [0, 0.0, 0.0, []]
+
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+        # Reservoir sample, so every timing has the same chance of being kept
+        if len(stats[3]) < maxSamples:
+            stats[3].append(seconds)
+        else:
+            i = random.randrange(stats[0])
+            if i < maxSamples:
+                stats[3][i] = seconds
+
+        if playerID is not None:
+            timings = playerTimings.setdefault(playerID, {})
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+# Times the with block as stage
+@contextmanager
+def timed(stage):
+    if not enabled:
+        yield
+        return
+
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - startTime)
+
+# Decorator. Times every call of the function, as a stage named after it unless a name is given
+def profiled(stage=None):
+    def decorator(function):
+        name = stage or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+
+            startTime = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - startTime)
+
+        return wrapper
+    return decorator
+
+# Sets the player that timings on this thread belong to. None for none
+def setPlayer(playerID):
+    currentPlayer.playerID = playerID
+
+# Returns and forgets every timing so far. For worker processes to send back to the main process, which adds them with mergeTimings
+def takeTimings():
+    global stageStats, playerTimings
+
+    with statsLock:
+        timings = (stageStats, playerTimings)
+        stageStats = {}
+        playerTimings = {}
+
+    return timings
+
+def mergeTimings(timings):
+
+    otherStageStats, otherPlayerTimings = timings
+
+    with statsLock:
+        for stage, (count, total, longest, samples) in otherStageStats.items():
+            stats = stageStats.get(stage)
+            if stats is None:
+                stats = stageStats[stage] = [0, 0.0, 0.0, []]
+            stats[0] += count
+            stats[1] += total
+            stats[2] = max(stats[2], longest)
+            stats[3].extend(samples)
+            if len(stats[3]) > maxSamples:
+                stats[3] = random.sample(stats[3], maxSamples)
+
+        for playerID, timings in otherPlayerTimings.items():
+            mine = playerTimings.setdefault(playerID, {})
+            for stage, seconds in timings.items():
+                mine[stage] = mine.get(stage, 0.0) + seconds
+
+def summarise(values):
+    values = sorted(values)
+    return {
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else None,
+    }
+
+# Returns the report as a dict
+# stages - For each stage, how many times it ran, for how long in total, and percentiles of single runs
+# players - For each stage, percentiles of the time each player spent in it, and the slowest players
+def getReport(totalSeconds=None):
+
+    with statsLock:
+        stages = {}
+        for stage, (count, total, longest, samples) in sorted(stageStats.items()):
+            stages[stage] = dict(count=count, total=total, mean=total / count, **summarise(samples))
+            stages[stage]["max"] = longest
+
+        perPlayer = { str(playerID): dict(timings) for playerID, timings in playerTimings.items() }
+
+    players = {}
+    for stage in stages:
+        times = [ (timings[stage], playerID) for playerID, timings in perPlayer.items() if stage in timings ]
+        if not times:
+            continue
+        players[stage] = summarise( [ t for t, playerID in times ] )
+        players[stage]["slowest"] = [ [playerID, t] for t, playerID in sorted(times, reverse=True)[:numSlowest] ]
+
+    return {
+        "total": totalSeconds,
+        "stages": stages,
+        "players": players,
+        "perPlayer": perPlayer,
+    }
+
+def writeReport(path=None, totalSeconds=None):
+
+    if path is None:
+        path = reportFile
+
+    with open(path, "w") as f:
+        json.dump(getReport(totalSeconds), f, indent=4)
+
+    print("Run profile written to " + path)
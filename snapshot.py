@@ -0,0 +1,172 @@
+#!python3
+###############################################################################
+# snapshot.py - In memory, column based copy of a players stats for LCSA 
+# jamesj223
+
+###############################################################################
+# Imports
+
+from collections import OrderedDict
+
+from database import cachedQuery, getDataVersion, getPlayerDB
+from profiler import profiled
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Number of player snapshots kept in memory
+snapshotCacheSize = 4
+
+###############################################################################
+# Columns
+# Each table is loaded as a dict of column name -> numpy array, one entry per row.
+# Missing numbers are loaded as -1, and missing text as ""
+# numpy is imported inside each function that needs it, so importing this module (and analysis.py) stays quick for runs that never load a snapshot
+
+matchesColumns = [
+    ("MatchID", "int64"),
+    ("ClubID", "int64"),
+    ("Season", str),
+    ("Grade", str),
+    ("Opponent", str),
+    ("HomeOrAway", str),
+]
+
+# Batting and Bowling rows also get the Matches columns above, joined on MatchID
+battingColumns = [
+    ("MatchID", "int64"),
+    ("Innings", "int8"),
+    ("Runs", "int16"),
+    ("Position", "int8"),
+    ("HowDismissed", str),
+]
+
+bowlingColumns = [
+    ("MatchID", "int64"),
+    ("Innings", "int8"),
+    ("Wickets", "int8"),
+    ("Runs", "int16"),
+    ("Maidens", "int8"),
+    ("Balls", "int16"),
+]
+
+###############################################################################
+# Functions
+
+# playerDB -> (data version, snapshot). Least recently used first
+snapshots = OrderedDict()
+
+# Turns a list of rows into a dict of typed numpy columns
+def rowsToColumns(rows, columns):
+    import numpy
+
+    table = {}
+
+    for i, (name, dtype) in enumerate(columns):
+
+        if dtype is str:
+            values = [ "" if row[i] is None else str(row[i]) for row in rows ]
+        else:
+            values = [ -1 if row[i] is None else row[i] for row in rows ]
+
+        table[name] = numpy.array(values, dtype=dtype)
+
+    return table
+
+# Loads a players Matches, Batting and Bowling tables into numpy columns, with Batting and Bowling joined to Matches on MatchID.
+# Rows keep the same order as "SELECT * FROM Batting" etc, so innings are still in the order they were played
+@profiled()
+def loadPlayerSnapshot(playerID):
+
+    playerDB = getPlayerDB(playerID)
+
+    version = getDataVersion(playerDB)
+    cached = snapshots.get(playerDB)
+    if cached is not None and cached[0] == version:
+        snapshots.move_to_end(playerDB)
+        return cached[1]
+
+    if debug:
+        print("Loading snapshot for " + str(playerID))
+
+    matchesSelect = ", ".join( [ name for name, dtype in matchesColumns ] )
+    joinedColumns = [ column for column in matchesColumns if column[0] != "MatchID" ]
+    joinedSelect = ", ".join( [ "m." + name for name, dtype in joinedColumns ] )
+
+    snapshot = {}
+
+    snapshot["Matches"] = rowsToColumns(cachedQuery(playerDB, "SELECT " + matchesSelect + " FROM Matches"), matchesColumns)
+
+    for discipline, columns in [("Batting", battingColumns), ("Bowling", bowlingColumns)]:
+
+        select = ", ".join( [ "d." + name for name, dtype in columns ] )
+        query = "SELECT " + select + ", " + joinedSelect + " FROM " + discipline + " d LEFT JOIN Matches m ON m.MatchID = d.MatchID"
+
+        snapshot[discipline] = rowsToColumns(cachedQuery(playerDB, query), columns + joinedColumns)
+
+    snapshots[playerDB] = (version, snapshot)
+    snapshots.move_to_end(playerDB)
+    while len(snapshots) > snapshotCacheSize:
+        snapshots.popitem(last=False)
+
+    return snapshot
+
+# Returns the rows of a table where mask is True
+def selectRows(table, mask):
+    return { name: column[mask] for name, column in table.items() }
+
+# Returns a mask of the rows where column is one of values
+def isIn(column, values):
+    import numpy
+    return numpy.isin(column, values)
+
+# Number of rows where mask is True
+def countTrue(mask):
+    import numpy
+    return int(numpy.count_nonzero(mask))
+
+# Returns the distinct values of a column, in the order they first appear
+def distinctValues(column):
+    import numpy
+    values, firstIndex = numpy.unique(column, return_index=True)
+    return [ value.item() for value in values[numpy.argsort(firstIndex)] ]
+
+# Totals used by getBattingStats
+# Returns (numInnings, highScore, notOuts, ducks, twentyFives, fifties, hundreds, aggregate)
+def battingTotals(table):
+    import numpy
+
+    runs = table["Runs"].astype("int64")
+    howDismissed = table["HowDismissed"]
+
+    numInnings = len(runs)
+    if numInnings == 0:
+        return (0, 0, 0, 0, 0, 0, 0, 0)
+
+    notOuts = numpy.count_nonzero( (howDismissed == "no") | (howDismissed == "rtno") )
+    ducks = numpy.count_nonzero( (runs == 0) & (howDismissed != "no") )
+    twentyFives = numpy.count_nonzero( (runs >= 25) & (runs < 50) )
+    fifties = numpy.count_nonzero( (runs >= 50) & (runs < 100) )
+    hundreds = numpy.count_nonzero( runs >= 100 )
+
+    return (numInnings, max(int(runs.max()), 0), int(notOuts), int(ducks), int(twentyFives), int(fifties), int(hundreds), int(runs.sum()))
+
+# Totals used by getBowlingStats
+# Returns (numInnings, balls, maidens, wickets, runs, fivefa)
+def bowlingTotals(table):
+    import numpy
+
+    wickets = table["Wickets"].astype("int64")
+
+    numInnings = len(wickets)
+    if numInnings == 0:
+        return (0, 0, 0, 0, 0, 0)
+
+    balls = int(table["Balls"].astype("int64").sum())
+    maidens = int(table["Maidens"].astype("int64").sum())
+    runs = int(table["Runs"].astype("int64").sum())
+    fivefa = int(numpy.count_nonzero(wickets >= 5))
+
+    return (numInnings, balls, maidens, int(wickets.sum()), runs, fivefa)
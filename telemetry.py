@@ -0,0 +1,153 @@
+#!python3
+###############################################################################
+# telemetry.py - Fetch metrics for LCSA
+# jamesj223
+
+###############################################################################
+# Imports
+
+import json, math, random, threading
+
+###############################################################################
+# User Input / Config
+
+debug = False
+
+# Written by writeMetrics at the end of a run
+metricsFile = "fetch-metrics.json"
+
+# Upper bounds, in seconds, of the request latency histogram buckets. Anything slower goes in the last, "inf" bucket
+latencyBuckets = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+# Most single request latencies kept, for the percentiles. Past that a random sample is kept, so a daemon running for weeks doesn't eat memory.
+# The count, mean, max and histogram are kept as running totals, so always cover every request
+maxLatencySamples = 10000
+
+###############################################################################
+# Functions
+# Counters are shared by every fetch thread, so all updates go through metricsLock
+
+metricsLock = threading.Lock()
+
+# Name of the latencyBuckets bucket a latency goes in
+def getBucket(latency):
+    for bound in latencyBuckets:
+        if latency <= bound:
+            return str(bound)
+    return "inf"
+
+# Counts latencies into the latencyBuckets
+def getHistogram(latencies):
+
+    histogram = { str(bound): 0 for bound in latencyBuckets }
+    histogram["inf"] = 0
+
+    for latency in latencies:
+        histogram[getBucket(latency)] += 1
+
+    return histogram
+
+def newMetrics():
+    return {
+        "requests": 0,          # Requests sent to the site, including retries
+        "pages": 0,             # Pages asked for, however they were served
+        "cacheHits": 0,         # Served from the page cache without asking the site
+        "notModified": 0,       # Site said the cached copy was still current (304)
+        "replayed": 0,          # Served from the fixture store
+        "retries": 0,
+        "failedPages": 0,       # Pages that ended in a FetchError
+        "bytes": 0,             # Body bytes downloaded
+        "statusCodes": {},
+        "errors": {},           # Requests that failed without a status code, by exception name
+        "breakerTrips": 0,
+        "latencyTotal": 0.0,
+        "latencyMax": None,
+        "latencyHistogram": getHistogram([]),
+        "latencies": [],        # Sample of the latencies, see maxLatencySamples
+    }
+
+metrics = newMetrics()
+
+def resetMetrics():
+    global metrics
+    with metricsLock:
+        metrics = newMetrics()
+
+# Adds to one of the counters
+def count(name, amount=1):
+    with metricsLock:
+        metrics[name] += amount
+
+# Records one request to the site. status is the status code, or None with error set to the exception if there wasn't one
+def recordRequest(latency, status=None, numBytes=0, error=None):
+    with metricsLock:
+        metrics["requests"] += 1
+        metrics["bytes"] += numBytes
+        metrics["latencyTotal"] += latency
+        metrics["latencyMax"] = max(latency, metrics["latencyMax"] or 0)
+        metrics["latencyHistogram"][getBucket(latency)] += 1
+
+        # Reservoir sample, so every request has the same chance of being kept
+        if len(metrics["latencies"]) < maxLatencySamples:
+            metrics["latencies"].append(latency)
+        else:
+            i = random.randrange(metrics["requests"])
+            if i < maxLatencySamples:
+                metrics["latencies"][i] = latency
+        if status is not None:
+            key = str(status)
+            metrics["statusCodes"][key] = metrics["statusCodes"].get(key, 0) + 1
+        if error is not None:
+            key = type(error).__name__
+            metrics["errors"][key] = metrics["errors"].get(key, 0) + 1
+
+# Value below which p percent of the sorted values fall. Nearest rank
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return None
+    index = max(math.ceil(p / 100 * len(sortedValues)) - 1, 0)
+    return sortedValues[index]
+
+# Returns the metrics as a dict, with the latencies summarised. The percentiles are from the sample, everything else covers every request
+def getSummary():
+
+    with metricsLock:
+        summary = dict(metrics)
+        summary["statusCodes"] = dict(metrics["statusCodes"])
+        summary["errors"] = dict(metrics["errors"])
+        histogram = dict(metrics["latencyHistogram"])
+        latencies = sorted(metrics["latencies"])
+
+    requests = summary["requests"]
+    latencyTotal = summary.pop("latencyTotal")
+
+    summary["latency"] = {
+        "count": requests,
+        "mean": latencyTotal / requests if requests else None,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": summary.pop("latencyMax"),
+        "histogram": histogram,
+    }
+
+    for name in ["latencies", "latencyHistogram"]:
+        del summary[name]
+
+    return summary
+
+# Writes the metrics summary to metricsFile
+def writeMetrics(path=None):
+
+    if path is None:
+        path = metricsFile
+
+    summary = getSummary()
+
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    if debug:
+        print("Fetch metrics written to " + path)
+
+    return summary